@@ -0,0 +1,128 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of routing records into the default cache structure, per record and batched.
+
+Usage: python bench/cache_routing.py [<number-of-records> [add|batch ...]]
+
+Synthetic records are added to a weekly/user/size/dataset cache built in
+a temporary directory, either one at a time with add, or in batches with
+addBatch, as Cache.update does.  Only the adding is timed, not generating
+the records, nor finalizing the cache, after which the caches built each
+way are checked to be identical.
+"""
+
+import functools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filebutler.Context import Context
+from filebutler.DatasetFilesetCache import DatasetFilesetCache
+from filebutler.DirectoryStore import DirectoryStore
+from filebutler.FilesetSelector import FilesetSelector
+from filebutler.Filespec import Filespec
+from filebutler.PooledFile import PooledFile
+from filebutler.SimpleFilesetCache import SimpleFilesetCache
+from filebutler.SizeFilesetCache import SizeFilesetCache
+from filebutler.UserFilesetCache import UserFilesetCache
+from filebutler.WeeklyFilesetCache import WeeklyFilesetCache
+
+levels = [WeeklyFilesetCache, UserFilesetCache, SizeFilesetCache, DatasetFilesetCache]
+attrs = {'sizebuckets': ['1k', '1M', '1G']}
+chunksize = 100000
+batchsize = 65536
+now = time.time()
+
+def newcache(parent, path, deltadir, ctx, attrs, sel, level, store):
+    if level < len(levels):
+        return levels[level](parent, path, deltadir, ctx, attrs, sel, functools.partial(newcache, level = level + 1, store = store), store)
+    else:
+        return SimpleFilesetCache(parent, path, deltadir, ctx, attrs, sel, store)
+
+def chunks(n):
+    """Yield lists of synthetic filespecs, n in all."""
+    rnd = random.Random(1)
+    users = ['root', 'jack', 'will', 'elizabeth']
+    groups = ['root', 'navy', 'crew']
+    datasets = ['pearl', 'revenge', 'scratch']
+    t0 = now - 2 * 365 * 86400
+    i = 0
+    while i < n:
+        chunk = []
+        for j in range(min(chunksize, n - i)):
+            dataset = rnd.choice(datasets)
+            path = "/dataset/%s/d%d/d%d/f%d.dat" % (dataset, rnd.randint(0, 20), rnd.randint(0, 20), i + j)
+            size = min(int(rnd.paretovariate(0.3)) - 1, 1 << 40)
+            chunk.append(Filespec(None, dataset, path, rnd.choice(users), rnd.choice(groups), size, int(rnd.uniform(t0, now)), '-rw-r--r--'))
+        i += len(chunk)
+        yield chunk
+
+def build(mode, n, path):
+    """Return the records added per second."""
+    cache = newcache(None, path, os.path.join(path, "delta"), Context(), attrs, FilesetSelector(), 0, DirectoryStore())
+    cache.create()
+    elapsed = 0.0
+    for chunk in chunks(n):
+        start = time.time()
+        if mode == 'add':
+            for filespec in chunk:
+                cache.add(filespec)
+        else:
+            for i in range(0, len(chunk), batchsize):
+                cache.addBatch(chunk[i:i + batchsize])
+        elapsed += time.time() - start
+    PooledFile.flushAll()
+    cache.finalize()
+    return n / elapsed
+
+def contents(path):
+    """Return the cache at path, as a dict of its files."""
+    result = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as f:
+                data = f.read()
+            result[os.path.relpath(os.path.join(root, name), path)] = json.loads(data) if name == 'info' else data
+    return result
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    modes = sys.argv[2:] if len(sys.argv) > 2 else ['add', 'batch']
+    tmpdir = tempfile.mkdtemp()
+    try:
+        built = None
+        for mode in modes:
+            path = os.path.join(tmpdir, mode)
+            rate = build(mode, n, path)
+            print("%-5s %9.0f records/s" % (mode, rate))
+            if built is None:
+                built = contents(path)
+            elif contents(path) != built:
+                sys.exit("FAILED: cache built with %s differs" % mode)
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
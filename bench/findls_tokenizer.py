@@ -0,0 +1,139 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Microbenchmark of tokenizing find -ls lines, before and after FindLsTokenizer.
+
+Usage: python bench/findls_tokenizer.py [<number-of-lines>]
+
+The baseline is the line parser which FindLsTokenizer replaced, kept here
+for comparison, and its records are checked to be identical.
+"""
+
+import calendar
+import datetime
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filebutler.Context import Context
+from filebutler.FindLsTokenizer import FindLsTokenizer
+from filebutler.Localtime import Localtime
+
+class BaselineParser(object):
+    """The original per-line parsing, including that of Pathway."""
+
+    def __init__(self, ctx, match, replace):
+        self._mapper = ctx.mapper
+        self._pathway = ctx.pathway
+        self._match = match
+        self._replace = replace
+        self._localtime = Localtime()
+        self._monthNumbers = {}
+        for i in range(12):
+            self._monthNumbers[calendar.month_abbr[i + 1]] = i + 1
+        self._today = datetime.datetime.today()
+
+    def _t(self, fields):
+        month = self._monthNumbers[fields[7]]
+        if len(fields[9]) == 4:
+            year = int(fields[9])
+        else:
+            if month <= self._today.month:
+                year = self._today.year
+            else:
+                year = self._today.year - 1
+        return self._localtime.t(year, month, int(fields[8]))
+
+    def _ignored(self, path):
+        for r in self._pathway._ignorePathRegexes:
+            if re.search(r, path):
+                return True
+        return False
+
+    def _datasetFromPath(self, path):
+        dataset, n = re.subn(self._pathway._datasetRegex, self._pathway._datasetReplace, path, 1)
+        return dataset if n == 1 else '-'
+
+    def parse(self, line):
+        fields = line.rstrip().split(None, 10)
+        if len(fields) > 10:
+            path = re.sub(self._match, self._replace, fields[10])
+            symlink = path.split(' -> ', 1)
+            if len(symlink) > 1:
+                path = symlink[0]
+                target = symlink[1]
+            else:
+                target = None
+            if not self._ignored(path):
+                return (self._datasetFromPath(path),
+                        path,
+                        self._mapper.usernameFromString(fields[4]),
+                        self._mapper.groupnameFromString(fields[5]),
+                        int(fields[6]),
+                        self._t(fields),
+                        fields[2],
+                        target)
+        return None
+
+def lines(n):
+    """Return n lines of synthetic find -ls output."""
+    rnd = random.Random(1)
+    users = ['root', 'jack', 'will', '1234', '0']
+    groups = ['root', 'navy', '500']
+    datasets = ['pearl', 'revenge', 'scratch']
+    result = []
+    for i in range(n):
+        if rnd.random() < 0.5:
+            date = "%s %2d  %d" % (calendar.month_abbr[rnd.randint(1, 12)], rnd.randint(1, 28), rnd.randint(2010, 2025))
+        else:
+            date = "%s %2d %02d:%02d" % (calendar.month_abbr[rnd.randint(1, 12)], rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59))
+        path = "%s/d%d/d%d/f%d.dat" % (rnd.choice(datasets), rnd.randint(0, 20), rnd.randint(0, 20), i)
+        if rnd.random() < 0.05:
+            path += " -> ../f%d.dat" % rnd.randint(0, n)
+        size = rnd.randint(0, 1 << 32)
+        result.append("%9d %7d -rw-r--r--   1 %-8s %-8s %12d %s %s\n" % (i, size // 1024, rnd.choice(users), rnd.choice(groups), size, date, path))
+    return result
+
+def bench(parser, lines):
+    """Return the records parsed, and the lines per second."""
+    start = time.time()
+    records = [parser.parse(line) for line in lines]
+    return records, len(lines) / (time.time() - start)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    ctx = Context()
+    ctx.pathway.setDatasetRegex(r'^/dataset/([^/]*)/.*$', r'\1')
+    with tempfile.NamedTemporaryFile('w', suffix='.ignore') as f:
+        f.write("^/dataset/[^/]+/[^/]+$\n^/dataset/[^/]+/[^/]+/\\.permissions_done$\n/d7/d7/\n")
+        f.flush()
+        ctx.pathway.setIgnorePathsFrom(f.name)
+    data = lines(n)
+    for match, replace in [('^', '/dataset/'), ('^([^/]*)', r'/dataset/\1')]:
+        before, before_rate = bench(BaselineParser(ctx, match, replace), data)
+        after, after_rate = bench(FindLsTokenizer(ctx, match, replace), data)
+        if before != after:
+            sys.exit("FAILED: records differ for match %s replace %s" % (match, replace))
+        print("match %-10s before %9.0f lines/s  after %9.0f lines/s  speedup %.2f" % (match, before_rate, after_rate, after_rate / before_rate))
+
+if __name__ == '__main__':
+    main()
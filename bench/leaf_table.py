@@ -0,0 +1,102 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+"""Benchmark of keeping a leaf in memory, as filespecs or as a LeafTable.
+
+Usage: python bench/leaf_table.py [<number-of-records>]
+
+Synthetic records for a single leaf are held in memory either as a list
+of filespecs, filtered with Filter.selects, as leaves are while within
+the read cache budget, or in a LeafTable, as they are compacted when
+over budget.  The memory used is measured, and the time taken by some
+filtered selects, after which the filespecs selected each way are
+checked to be identical.
+"""
+
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filebutler.FilesetSelector import FilesetSelector
+from filebutler.Filespec import Filespec
+from filebutler.Filter import Filter
+from filebutler.LeafTable import LeafTable
+from filebutler.MTimeFilter import MTimeFilter
+
+now = time.time()
+sel = FilesetSelector('jack', 'pearl', None)
+filters = [
+    ('all', None),
+    ('size', Filter(sizeGeq=1024 * 1024)),
+    ('mtime', Filter(mtime=MTimeFilter(before=int(now - 365 * 86400)))),
+    ('regex', Filter(regex='d1/.*f[0-9]*7\\.dat')),
+    ('size+path', Filter(sizeGeq=1024, notPaths=['*/d2/*'])),
+]
+
+def records(n):
+    """Return a list of n synthetic records, sorted by path, which is encoded as in a filelist."""
+    rnd = random.Random(1)
+    groups = ['root', 'navy', 'crew']
+    perms = ['-rw-r--r--', '-rw-rw-r--', 'drwxr-xr-x']
+    t0 = now - 2 * 365 * 86400
+    result = []
+    for i in range(n):
+        path = "/dataset/pearl/d%d/d%d/f%d.dat" % (rnd.randint(0, 20), rnd.randint(0, 20), i)
+        size = min(int(rnd.paretovariate(0.3)) - 1, 1 << 40)
+        result.append((rnd.choice(groups), size, int(rnd.uniform(t0, now)), rnd.choice(perms), path))
+    result.sort(key=lambda r: r[4])
+    return [(group, size, mtime, perms, path.encode('utf-8')) for group, size, mtime, perms, path in result]
+
+def load(mode, rows):
+    """Return the leaf in memory, with paths decoded as they are read, as BinaryFilelist does."""
+    filespecs = [Filespec(None, sel.dataset, path.decode('utf-8'), sel.owner, group, size, mtime, perms) for group, size, mtime, perms, path in rows]
+    return filespecs if mode == 'filespecs' else LeafTable(filespecs)
+
+def select(mode, leaf, filter):
+    if mode == 'filespecs':
+        return [filespec for filespec in leaf if filter is None or filter.selects(filespec)]
+    else:
+        return list(leaf.select(filter, None, sel))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rows = records(n)
+    selected = {}
+    for mode in ['filespecs', 'table']:
+        gc.collect()
+        tracemalloc.start()
+        leaf = load(mode, rows)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("%-9s %6.1f bytes/record" % (mode, size / n))
+        for name, filter in filters:
+            start = time.time()
+            result = select(mode, leaf, filter)
+            print("  %-9s %7d selected in %.3fs" % (name, len(result), time.time() - start))
+            result = [str(filespec) for filespec in result]
+            if name not in selected:
+                selected[name] = result
+            elif result != selected[name]:
+                sys.exit("FAILED: %s selected differently" % name)
+        leaf = None
+
+if __name__ == '__main__':
+    main()
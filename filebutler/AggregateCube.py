@@ -0,0 +1,187 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import struct
+import time
+
+from .Buckets import Buckets
+from .FilesetInfo import FilesetInfo
+from .FilesetSelector import FilesetSelector
+
+class AggregateCube(object):
+    """Number of files and total size by user, dataset, size bucket, and day.
+
+    The day is the local date of the mtime, as an ordinal, so the cube
+    may answer any query on those dimensions without reading the cache,
+    except where an mtime bound falls within a day, which is left to
+    the caller.
+
+    The file format is a magic number and format version, the size
+    bucket bounds, the tables of users and datasets, and then the cells.
+    """
+
+    magic = b'\0FBC'
+    version = 1
+
+    _header = struct.Struct('<4sHH')    # magic, version, reserved
+    _count = struct.Struct('<I')
+    _strlen = struct.Struct('<H')
+    _bound = struct.Struct('<Q')
+    _cell = struct.Struct('<IIHiQQ')    # user, dataset, bucket, day, nFiles, totalSize
+
+    @classmethod
+    def _readTable(cls, f, read):
+        n, = cls._count.unpack(read(cls._count.size))
+        strings = []
+        for i in range(n):
+            length, = cls._strlen.unpack(read(cls._strlen.size))
+            strings.append(read(length).decode('utf-8', 'surrogateescape'))
+        return strings
+
+    @classmethod
+    def fromFile(cls, f):
+        def read(n):
+            b = f.read(n)
+            if len(b) != n:
+                raise IOError("truncated cube")
+            return b
+        magic, version, _ = cls._header.unpack(read(cls._header.size))
+        if magic != cls.magic:
+            raise IOError("bad cube")
+        if version != cls.version:
+            raise IOError("unsupported cube version %d" % version)
+        n, = cls._count.unpack(read(cls._count.size))
+        bounds = [cls._bound.unpack(read(cls._bound.size))[0] for i in range(n)]
+        cube = cls(bounds)
+        users = cls._readTable(f, read)
+        datasets = cls._readTable(f, read)
+        n, = cls._count.unpack(read(cls._count.size))
+        for user, dataset, bucket, day, nFiles, totalSize in cls._cell.iter_unpack(read(n * cls._cell.size)):
+            cube._update(users[user], datasets[dataset], bucket, day, nFiles, totalSize)
+        return cube
+
+    def __init__(self, bounds):
+        self._sizebuckets = Buckets(bounds)
+        self._cells = {}        # indexed by (user, dataset), of [nFiles, totalSize] indexed by (bucket, day)
+        self._days = {}         # memo of day, indexed by quarter hour
+
+    @property
+    def bounds(self):
+        return [self._sizebuckets.bound(i) for i in range(self._sizebuckets.len)]
+
+    def day(self, t):
+        """Return the day containing time t."""
+        # all timezone offsets are a whole number of quarter hours
+        q = int(t) // 900
+        d = self._days.get(q)
+        if d is None:
+            d = datetime.date.fromtimestamp(q * 900).toordinal()
+            self._days[q] = d
+        return d
+
+    def dayStart(self, d):
+        return time.mktime(datetime.date.fromordinal(d).timetuple())
+
+    def _update(self, user, dataset, bucket, day, nFiles, totalSize):
+        key = (user, dataset)
+        cells = self._cells.get(key)
+        if cells is None:
+            cells = {}
+            self._cells[key] = cells
+        cell = cells.get((bucket, day))
+        if cell is None:
+            if nFiles > 0:
+                cells[(bucket, day)] = [nFiles, totalSize]
+        else:
+            cell[0] += nFiles
+            cell[1] += totalSize
+            if cell[0] <= 0:
+                # no files left
+                del cells[(bucket, day)]
+
+    def add(self, filespec):
+        self._update(filespec.user, filespec.dataset, self._sizebuckets.indexContaining(filespec.size), self.day(filespec.mtime), 1, filespec.size)
+
+    def remove(self, filespec):
+        self._update(filespec.user, filespec.dataset, self._sizebuckets.indexContaining(filespec.size), self.day(filespec.mtime), -1, -filespec.size)
+
+    def subtract(self, cube):
+        for (user, dataset), cells in cube._cells.items():
+            for (bucket, day), (nFiles, totalSize) in cells.items():
+                self._update(user, dataset, bucket, day, -nFiles, -totalSize)
+
+    def split(self, after, before):
+        """Split the mtime interval into whole days, and the partial intervals at either end.
+
+        Return the first day and the end day, either of which may be None
+        for unbounded, and a list of (after, before) partial intervals.
+        """
+        partial = []
+        firstDay = None
+        endDay = None
+        if after is not None:
+            firstDay = self.day(after)
+            if self.dayStart(firstDay) != after:
+                firstDay += 1
+                nextStart = self.dayStart(firstDay)
+                partial.append((after, nextStart if before is None else min(nextStart, before)))
+        if before is not None:
+            endDay = self.day(before)
+            start = self.dayStart(endDay)
+            if start != before and (after is None or start > after):
+                partial.append((start, before))
+        return firstDay, endDay, partial
+
+    def merge_info(self, acc, owner=None, dataset=None, minBucket=0, firstDay=None, endDay=None):
+        """Merge the info for whole days from firstDay up to but excluding endDay."""
+        for (user0, dataset0), cells in self._cells.items():
+            if (owner is None or user0 == owner) and (dataset is None or dataset0 == dataset):
+                infos = {}      # indexed by bucket
+                for (bucket, day), (nFiles, totalSize) in cells.items():
+                    if bucket >= minBucket and (firstDay is None or day >= firstDay) and (endDay is None or day < endDay):
+                        info = infos.get(bucket)
+                        if info is None:
+                            info = FilesetInfo()
+                            infos[bucket] = info
+                        info.add(nFiles, totalSize)
+                sel = FilesetSelector(user0, dataset0)
+                for bucket in sorted(infos.keys()):
+                    acc.accumulateInfo(infos[bucket], sel.withSizebucket(self._sizebuckets.bound(bucket)))
+
+    def write(self, f):
+        users = {}
+        datasets = {}
+        cells = []
+        for (user, dataset), cells0 in self._cells.items():
+            u = users.setdefault(user, len(users))
+            d = datasets.setdefault(dataset, len(datasets))
+            for (bucket, day), (nFiles, totalSize) in cells0.items():
+                cells.append(self._cell.pack(u, d, bucket, day, nFiles, totalSize))
+        f.write(self._header.pack(self.magic, self.version, 0))
+        bounds = self.bounds
+        f.write(self._count.pack(len(bounds)))
+        for b in bounds:
+            f.write(self._bound.pack(b))
+        for table in (users, datasets):
+            f.write(self._count.pack(len(table)))
+            for s in table:
+                b = s.encode('utf-8', 'surrogateescape')
+                f.write(self._strlen.pack(len(b)))
+                f.write(b)
+        f.write(self._count.pack(len(cells)))
+        f.write(b''.join(cells))
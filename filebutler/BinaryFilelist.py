@@ -0,0 +1,205 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import struct
+
+from .Filespec import Filespec
+
+class BinaryFilelist(object):
+    """Reader and writer for the binary format of sorted leaf filelists.
+
+    A binary filelist begins with a magic number and format version, then
+    the tables of distinct groups and perms in the leaf.  The records follow
+    in blocks, terminated by an empty block.  Each block has a header giving
+    its number of records and the size of its string heap, then the fixed
+    size records, then the heap holding their paths.  A record has integer
+    mtime (UTC seconds since epoch) and size, indexes into the group and
+    perms tables, and the length of its path in the heap.
+
+    Since records are sorted by path, paths are front coded, that is, a
+    record has the length of the prefix it shares with the previous path,
+    and only the remaining suffix is in the heap.  Each block is a restart
+    point, with no prefix shared with the previous block, so blocks may
+    be skipped without reading them.  Version 1 had no front coding.
+
+    While the cache is being built, records are staged as text lines with
+    integer mtime, which are parsed without any date conversion when the
+    leaf is sorted and written out in binary.
+    """
+
+    magic = b'\0FBL'
+    version = 2
+    blocksize = 4096            # records per block
+
+    _header = struct.Struct('<4sHH')    # magic, version, reserved
+    _count = struct.Struct('<I')
+    _strlen = struct.Struct('<H')
+    _blockheader = struct.Struct('<II') # nRecords, heap size
+    _record = struct.Struct('<qQIHHI')  # mtime, size, group, perms, shared prefix length, suffix length
+    _record1 = struct.Struct('<qQIHI')  # version 1: mtime, size, group, perms, path length
+    maxShared = 0xffff
+
+    @classmethod
+    def detect(cls, f):
+        """Return whether the file is in binary format, leaving it positioned at the start."""
+        isBinary = f.read(len(cls.magic)) == cls.magic
+        f.seek(0)
+        return isBinary
+
+    @classmethod
+    def staged(cls, filespec):
+        """Return filespec formatted as a staging line."""
+        return "%s %d %d %s %s\n" % (
+            filespec.group,
+            filespec.size,
+            filespec.mtime,
+            filespec.perms,
+            filespec.path)
+
+    @classmethod
+    def unstaged(cls, line):
+        """Return a staging line as a record tuple (group, size, mtime, perms, path)."""
+        fields = line.rstrip('\n').split(' ', 4)
+        return fields[0], int(fields[1]), int(fields[2]), fields[3], fields[4]
+
+    @classmethod
+    def stagedPath(cls, line):
+        """Return the path from a staging line, for sorting."""
+        return line.rstrip('\n').split(' ', 4)[4]
+
+    @classmethod
+    def _writeTable(cls, f, strings):
+        f.write(cls._count.pack(len(strings)))
+        for s in strings:
+            b = s.encode('utf-8', 'surrogateescape')
+            f.write(cls._strlen.pack(len(b)))
+            f.write(b)
+
+    @classmethod
+    def write(cls, f, records, groups=None, perms=None):
+        """Write records sorted by path to binary file f.
+
+        The group and perms tables are computed from the records if not
+        given, in which case records must be a list.
+        """
+        if groups is None:
+            groups = sorted(set([r[0] for r in records]))
+        if perms is None:
+            perms = sorted(set([r[3] for r in records]))
+        groupIndex = dict([(g, i) for i, g in enumerate(groups)])
+        permsIndex = dict([(p, i) for i, p in enumerate(perms)])
+        f.write(cls._header.pack(cls.magic, cls.version, 0))
+        cls._writeTable(f, groups)
+        cls._writeTable(f, perms)
+        pack = cls._record.pack
+        block = []
+        heap = []
+        prev = b''
+        for group, size, mtime, perms0, path in records:
+            b = path.encode('utf-8', 'surrogateescape')
+            shared = min(len(os.path.commonprefix([prev, b])), cls.maxShared)
+            block.append(pack(mtime, size, groupIndex[group], permsIndex[perms0], shared, len(b) - shared))
+            heap.append(b[shared:])
+            prev = b
+            if len(block) == cls.blocksize:
+                cls._writeBlock(f, block, heap)
+                block = []
+                heap = []
+                # restart point
+                prev = b''
+        if block:
+            cls._writeBlock(f, block, heap)
+        # terminating empty block
+        f.write(cls._blockheader.pack(0, 0))
+
+    @classmethod
+    def _writeBlock(cls, f, block, heap):
+        heapbytes = b''.join(heap)
+        f.write(cls._blockheader.pack(len(block), len(heapbytes)))
+        f.write(b''.join(block))
+        f.write(heapbytes)
+
+    def __init__(self, f, start=0):
+        """Reader for binary file f, skipping the first start records."""
+        self._f = f
+        self._pos = start
+
+    def tell(self):
+        """Return the number of records read, for resuming with a new reader."""
+        return self._pos
+
+    def _read(self, n):
+        b = self._f.read(n)
+        if len(b) != n:
+            raise IOError("truncated binary filelist")
+        return b
+
+    def _readTable(self):
+        n, = self._count.unpack(self._read(self._count.size))
+        strings = []
+        for i in range(n):
+            length, = self._strlen.unpack(self._read(self._strlen.size))
+            strings.append(self._read(length).decode('utf-8', 'surrogateescape'))
+        return strings
+
+    def filespecs(self, fileset, sel):
+        """Yield filespecs, with owner and dataset taken from the selector."""
+        magic, version, _ = self._header.unpack(self._read(self._header.size))
+        if magic != self.magic:
+            raise IOError("bad binary filelist")
+        if version not in (1, self.version):
+            raise IOError("unsupported binary filelist version %d" % version)
+        groups = self._readTable()
+        perms = self._readTable()
+        record = self._record if version == self.version else self._record1
+        recordsize = record.size
+        i = 0
+        while True:
+            nRecords, heapsize = self._blockheader.unpack(self._read(self._blockheader.size))
+            if nRecords == 0:
+                break
+            if i + nRecords <= self._pos:
+                # skip over block which has been read already
+                self._read(nRecords * recordsize + heapsize)
+                i += nRecords
+                continue
+            records = self._read(nRecords * recordsize)
+            heap = self._read(heapsize)
+            offset = 0
+            path = b''
+            for fields in record.iter_unpack(records):
+                if version == 1:
+                    mtime, size, group, perms0, length = fields
+                    shared = 0
+                else:
+                    mtime, size, group, perms0, shared, length = fields
+                end = offset + length
+                # rebuild path from the previous one
+                path = path[:shared] + heap[offset:end]
+                if i >= self._pos:
+                    self._pos = i + 1
+                    yield Filespec(fileset,
+                                   sel.dataset,
+                                   path.decode('utf-8', 'surrogateescape'),
+                                   sel.owner,
+                                   groups[group],
+                                   size,
+                                   mtime,
+                                   perms[perms0])
+                offset = end
+                i += 1
@@ -16,6 +16,8 @@
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import bisect
+
 class Buckets(object):
 
     def __init__(self, bounds):
@@ -35,16 +37,16 @@ class Buckets(object):
 
     def indexContaining(self, x):
         """Return slot containing a given value."""
-        for i in reversed(list(range(len(self._bounds)))):
-            if x >= self._bounds[i]:
-                return i
+        i = bisect.bisect_right(self._bounds, x) - 1
+        if i >= 0:
+            return i
         raise ValueError("no slot containing %d, %s" % (x, str(self._bounds)))
 
     def index(self, b):
         """Return slot for given bound."""
-        for i in reversed(list(range(len(self._bounds)))):
-            if b == self._bounds[i]:
-                return i
+        i = bisect.bisect_left(self._bounds, b)
+        if i < len(self._bounds) and self._bounds[i] == b:
+            return i
         raise ValueError("no slot with bound %d, %s" % (b, str(self._bounds)))
 
     def bound(self, i):
@@ -42,10 +42,12 @@ from .FindFileset import FindFileset
 from .GnuFindOutFileset import GnuFindOutFileset
 from .Grouper import Grouper
 from .Pager import Pager
+from .PooledFile import PooledFile
+from .ReadCache import ReadCache
 from .UnionFileset import UnionFileset
 from .aliases import read_etc_aliases
 from .options import parseCommandOptions
-from .util import stderr, debug_log, initialize, profile, unix_time, yes_or_no, daystart
+from .util import stderr, debug_log, initialize, profile, unix_time, yes_or_no, daystart, attrint, attrsize
 
 class CLI(object):
 
@@ -91,6 +93,10 @@ class CLI(object):
                                'usage': 'ls-caches',
                                'method': self._lsCachesCmd,
             },
+            'stats':         { 'desc': 'show statistics for the in-memory read cache',
+                               'usage': 'stats',
+                               'method': self._statsCmd,
+            },
             'fileset':       { 'desc': 'define a fileset',
                                'usage': 'fileset <name> find.gnu.out|find|filter|union <spec>',
                                'method': self._filesetCmd,
@@ -120,7 +126,7 @@ class CLI(object):
                                'method': self._symlinksCmd,
             },
             'update-cache':  { 'desc': 'update all or named caches, by rescanning source filelists',
-                               'usage': 'update-cache [<fileset> ...]',
+                               'usage': 'update-cache [-full] [<fileset> ...]',
                                'method': self._updateCacheCmd,
             },
             'send-emails':   { 'privileged': True,
@@ -301,6 +307,12 @@ class CLI(object):
             if len(values) != 1:
                 raise CLIError("botched attr %s" % name)
             self._ctx.pathway.setIgnorePathsFrom(values[0])
+        if name == 'maxopenfiles':
+            PooledFile.setMaxOpen(attrint(self._attrs, name, PooledFile.defaultMaxOpen))
+        if name == 'writebuffer':
+            PooledFile.setWriteBuffer(attrsize(self._attrs, name, PooledFile.defaultWriteBuffer))
+        if name == 'readcache':
+            ReadCache.setBudget(attrsize(self._attrs, name, ReadCache.defaultBudget))
 
     def _clearCmd(self, toks, usage):
         if len(toks) != 2:
@@ -309,6 +321,12 @@ class CLI(object):
         del self._attrs[name]
         if name == 'dataset':
             self._ctx.pathway.clearDatasetRegex()
+        if name == 'maxopenfiles':
+            PooledFile.setMaxOpen(PooledFile.defaultMaxOpen)
+        if name == 'writebuffer':
+            PooledFile.setWriteBuffer(PooledFile.defaultWriteBuffer)
+        if name == 'readcache':
+            ReadCache.setBudget(ReadCache.defaultBudget)
 
     def _lsAttrsCmd(self, toks, usage):
         if len(toks) != 1:
@@ -329,6 +347,11 @@ class CLI(object):
             if name in self._caches:
                 print(self._filesets[name].description())
 
+    def _statsCmd(self, toks, usage):
+        if len(toks) != 1:
+            raise CLIError("usage: %s" % usage)
+        print(ReadCache.stats())
+
     def _filesetCmd(self, toks, usage):
         if len(toks) < 3:
             raise CLIError("usage: %s" % usage)
@@ -337,9 +360,9 @@ class CLI(object):
         if name in self._filesets:
             raise CLIError("duplicate fileset %s" % name)
         if type == "find.gnu.out":
-            fileset = self._cached(name, GnuFindOutFileset.parse(self._ctx, name, toks[3:]))
+            fileset = self._cached(name, GnuFindOutFileset.parse(self._ctx, name, toks[3:], self._attrs))
         elif type == "find":
-            fileset = self._cached(name, FindFileset.parse(self._ctx, name, toks[3:]))
+            fileset = self._cached(name, FindFileset.parse(self._ctx, name, toks[3:], self._attrs))
         elif type == "filter":
             if len(toks) < 4:
                 raise CLIError("filter requires fileset, criteria")
@@ -441,6 +464,7 @@ class CLI(object):
         with open(outpath, "w") as outfile:
             condaEnvCounter = CondaEnvCounter()
             try:
+                # counting conda environments depends on path order
                 for filespec in fileset.select():
                     condaEnvCounter.add(filespec)
                 condaEnvCounter.dump(outfile)
@@ -473,7 +497,8 @@ class CLI(object):
             # delete directories after their contents
             dirs = []
             mtimes = {}
-            for filespec in fileset.select(filter):
+            # order doesn't matter here, since directories are sorted below
+            for filespec in fileset.scan(filter):
                 # preserve mtime for parent directory
                 parent = os.path.dirname(filespec.path)
                 if parent not in mtimes:
@@ -563,13 +588,15 @@ class CLI(object):
         return fileset.completeSymlinks(prefix)
 
     def _updateCacheCmd(self, toks, usage):
-        if len(toks) == 1:
+        full = len(toks) > 1 and toks[1] == '-full'
+        names = toks[2:] if full else toks[1:]
+        if len(names) == 0:
             for name in sorted(list(self._caches.keys())):
                 #print("updating cache %s" % name)
-                self._caches[name].update()
+                self._caches[name].update(full)
         else:
-            for name in toks[1:]:
-                self._cache(name).update()
+            for name in names:
+                self._cache(name).update(full)
 
     def _attrsAsStringMap(self):
         s = {}
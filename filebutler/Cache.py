@@ -15,22 +15,53 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import errno
 import functools
+import json
+import multiprocessing
 import os.path
+import shutil
+import tempfile
 
+from .AggregateCube import AggregateCube
+from .CacheCompression import CacheCompression
 from .CLIError import CLIError
 from .ConfigError import ConfigError
 from .DatasetFilesetCache import DatasetFilesetCache
+from .DirectoryStore import DirectoryStore
 from .Fileset import Fileset
 from .FilesetSelector import FilesetSelector
-from .PooledFile import PooledFile
+from .InfoIndex import InfoIndex
+from .Filespec import Filespec
+from .Filter import Filter
+from .MTimeFilter import MTimeFilter
+from .PackedStore import PackedStore
+from .PooledFile import PooledFile, listdir
+from .ResultCache import ResultCache
 from .SimpleFilesetCache import SimpleFilesetCache
 from .SizeFilesetCache import SizeFilesetCache
+from .SqliteFilesetCache import SqliteFilesetCache
 from .SymlinkCache import SymlinkCache
 from .UserFilesetCache import UserFilesetCache
 from .WeeklyFilesetCache import WeeklyFilesetCache
-from .util import filedatestr, filetimestr, verbose_stderr, debug_log, progress_stderr, warning
+from .util import filedatestr, filetimestr, verbose_stderr, debug_log, progress_stderr, warning, attrint, str2size, size2str
+
+def _buildPartition(cache, conn):
+    """Build the children of the top level cache for one partition, in a worker process."""
+    raw0, stored0 = CacheCompression.written()
+    keys = collections.OrderedDict()    # of children built here
+    for records in iter(conn.recv, None):
+        filespecs = [Filespec(None, *record) for record in records]
+        cache.addBatch(filespecs)
+        for filespec in filespecs:
+            keys[cache.childKey(filespec)] = True
+    # ensure from here on we don't hit open file problems
+    PooledFile.flushAll()
+    cache.finalizeChildren(keys)
+    raw, stored = CacheCompression.written()
+    conn.send((raw - raw0, stored - stored0))
 
 # Stack up the caches we support, so that each cache can instantiate
 # its next one, via its next parameter.
@@ -43,6 +74,7 @@ class Cache(Fileset):
         'user':    UserFilesetCache,
     }
     defaultCacheKinds = ['weekly', 'user', 'size', 'dataset']
+    batchsize = 65536   # filespecs routed through the cache together
 
     def __init__(self, name, fileset, path, deltadir, ctx, attrs):
         super(self.__class__, self).__init__()
@@ -53,12 +85,38 @@ class Cache(Fileset):
         self._ctx = ctx
         self._attrs = attrs.copy() # copy the dictionary, so we freeze its values
         self._cache0 = None
+        self._cube0 = None
+        self._deletedCube0 = None
+        self._infoIndex0 = None
+        self._resultCache0 = None
+        self._staging0 = None
         cacheKinds = self._attrs['cache'] if 'cache' in self._attrs else self.__class__.defaultCacheKinds
         try:
             self._caches = [self.__class__.caches[kind] for kind in cacheKinds]
         except KeyError as e:
             raise ConfigError("invalid cache kind '%s' (valid kinds are %s)" % (e, ', '.join(sorted(self.__class__.caches.keys()))))
+        if 'filelistformat' in self._attrs and self._attrs['filelistformat'] not in (['binary'], ['text']):
+            raise ConfigError("invalid filelistformat '%s' (valid formats are binary, text)" % ' '.join(self._attrs['filelistformat']))
+        if 'cachestore' in self._attrs and self._attrs['cachestore'] not in (['directory'], ['packed'], ['sqlite']):
+            raise ConfigError("invalid cachestore '%s' (valid stores are directory, packed, sqlite)" % ' '.join(self._attrs['cachestore']))
+        self._cachestore = self._attrs['cachestore'][0] if 'cachestore' in self._attrs else 'directory'
+        if self._cachestore != 'directory' and 'private' in self._attrs:
+            # privacy relies on directory permissions
+            raise ConfigError("private caches must use the directory cachestore")
+        if 'incrementalupdate' in self._attrs and 'private' in self._attrs:
+            # privacy relies on directory ownership, which isn't preserved when merged
+            raise ConfigError("private caches can't be updated incrementally")
+        if 'incrementalupdate' in self._attrs and self._cachestore != 'directory':
+            warning("incrementalupdate ignored for cache %s, as only the directory cachestore supports it" % self.name)
+        self._compression = self._attrs['cachecompression'][0] if 'cachecompression' in self._attrs else 'none'
+        if 'cachecompression' in self._attrs and (len(self._attrs['cachecompression']) != 1 or self._compression not in CacheCompression.codecs):
+            raise ConfigError("invalid cachecompression '%s' (valid codecs are %s)" % (' '.join(self._attrs['cachecompression']), ', '.join(CacheCompression.codecs)))
+        if self._compression not in CacheCompression.available():
+            raise ConfigError("cachecompression %s unavailable, missing Python package" % self._compression)
+        if self._compression != 'none' and self._cachestore == 'sqlite':
+            raise ConfigError("cachecompression is not supported for the sqlite cachestore")
         self._symlinks = SymlinkCache(self._path)
+        self._workers = attrint(self._attrs, 'workers', 1)
 
     def _exists(self):
         try:
@@ -83,14 +141,40 @@ class Cache(Fileset):
 
     def _cache(self):
         if self._cache0 is None:
-            self._cache0 = self._newcache(None, self._path, self._deltadir, self._ctx, self._attrs, FilesetSelector(), 0)
+            # we are the parent of the top level, so we see deletions
+            if self._cachestore == 'sqlite':
+                cache = SqliteFilesetCache(self, self._path, self._deltadir, self._ctx, self._attrs)
+                if not os.path.exists(cache.dbpath()):
+                    raise CLIError("missing database, use 'update-cache %s', or 'update-cache' for all" % self.name)
+                self._cache0 = cache
+                return self._cache0
+            if self._cachestore == 'packed':
+                try:
+                    store = PackedStore(self._path, self._packpath())
+                except IOError:
+                    raise CLIError("can't read packed cache, use 'update-cache %s', or 'update-cache' for all" % self.name)
+            else:
+                store = DirectoryStore()
+            self._cache0 = self._newcache(self, self._path, self._deltadir, self._ctx, self._attrs, FilesetSelector(), 0, store)
         return self._cache0
 
-    def _newcache(self, parent, path, deltadir, ctx, attrs, sel, level):
+    def _newcache(self, parent, path, deltadir, ctx, attrs, sel, level, store):
         if level < len(self._caches):
-            return self._caches[level](parent, path, deltadir, ctx, attrs, sel, functools.partial(self._newcache, level = level + 1))
+            return self._caches[level](parent, path, deltadir, ctx, attrs, sel, functools.partial(self._newcache, level = level + 1, store = store), store)
+        else:
+            return SimpleFilesetCache(parent, path, deltadir, ctx, attrs, sel, store)
+
+    def _packpath(self):
+        return os.path.join(self._path, "pack")
+
+    def _stagingpath(self):
+        """Return where a packed or incrementally updated cache is built, before being packed or merged."""
+        if 'stagingdir' in self._attrs:
+            return os.path.join(self._attrs['stagingdir'][0], self.name)
+        elif self._staging0 is not None:
+            return self._staging0
         else:
-            return SimpleFilesetCache(parent, path, deltadir, ctx, attrs, sel)
+            return os.path.join(self._path, "staging")
 
     def select(self, filter=None):
         self._abortIfMissingCache()
@@ -100,29 +184,221 @@ class Cache(Fileset):
         for filespec in cache.select(filter):
             yield filespec
 
+    def scan(self, filter=None):
+        self._abortIfMissingCache()
+        cache = self._cache()
+        filterStr = " " + str(filter) if filter is not None else ""
+        verbose_stderr("fileset %s%s scanning %s cache at %s\n" % (self.name, filterStr, filetimestr(self._path), self._path))
+        for filespec in cache.scan(filter):
+            yield filespec
+
     def merge_info(self, acc, filter=None):
         self._abortIfMissingCache()
         #debug_log("Cache(%s) merge_info\n" % self.name)
         cache = self._cache()
-        cache.merge_info(acc, filter)
+        # unfiltered info is read from the top level of the cache, otherwise try the cube
+        cube = self._cube() if filter is not None else None
+        if cube is not None and filter.consistent and filter.notPaths == [] and filter.regex is None and (filter.sizeGeq is None or filter.sizeGeq in cube.bounds):
+            verbose_stderr("fileset %s %s reading from cube\n" % (self.name, str(filter)))
+            minBucket = 0 if filter.sizeGeq is None else cube.bounds.index(filter.sizeGeq)
+            if filter.mtime is None:
+                firstDay, endDay, partial = None, None, []
+            else:
+                firstDay, endDay, partial = cube.split(filter.mtime.after, filter.mtime.before)
+            cube.merge_info(acc, filter.owner, filter.dataset, minBucket, firstDay, endDay)
+            # the cube only has whole days, so scan for the part days at either end
+            for after, before in partial:
+                cache.merge_info(acc, filter.intersect(Filter(mtime=MTimeFilter(before=before, after=after))))
+        else:
+            cache.merge_info(acc, filter)
 
-    def update(self):
-        cache = self._cache()
+    def _cubepath(self, deleted=False):
+        if deleted:
+            return os.path.join(self._deltadir, "deleted.cube")
+        else:
+            return os.path.join(self._path, "cube")
+
+    def _infoindexpath(self):
+        return os.path.join(self._path, "infoindex")
+
+    def infoIndex(self):
+        """Return the info index, or None if there isn't one."""
+        if self._infoIndex0 is None:
+            indexpath = self._infoindexpath()
+            try:
+                self._infoIndex0 = InfoIndex(self._path, self._deltadir, indexpath)
+            except FileNotFoundError:
+                # cache predates info index
+                self._infoIndex0 = False
+            except IOError:
+                warning("can't read info index %s, ignoring" % indexpath)
+                self._infoIndex0 = False
+        return self._infoIndex0 if self._infoIndex0 else None
+
+    def _resultspath(self):
+        return os.path.join(self._path, "results")
+
+    def resultCache(self):
+        """Return the result cache, or None if there isn't one."""
+        if self._resultCache0 is None:
+            # private caches are protected by directory permissions, which the result cache would bypass
+            if self._cachestore != 'sqlite' and 'private' not in self._attrs:
+                self._resultCache0 = ResultCache(self._path, self._resultspath())
+            else:
+                self._resultCache0 = False
+        return self._resultCache0 if self._resultCache0 else None
+
+    def _newCube(self):
+        return AggregateCube([str2size(s) for s in self._attrs['sizebuckets']] if 'sizebuckets' in self._attrs else [])
+
+    def _cube(self):
+        """Return the aggregate cube less any deletions, or None if there isn't one."""
+        if self._cube0 is None:
+            cubepath = self._cubepath()
+            try:
+                with open(cubepath, 'rb') as f:
+                    cube = AggregateCube.fromFile(f)
+                if cube.bounds != self._newCube().bounds:
+                    # sizebuckets changed since the cache was updated, so the cube disagrees with the leaves
+                    verbose_stderr("cache %s cube is stale, until update-cache\n" % self.name)
+                    self._cube0 = False
+                else:
+                    cube.subtract(self._deletedCube())
+                    self._cube0 = cube
+            except FileNotFoundError:
+                # cache predates cubes
+                self._cube0 = False
+            except IOError:
+                warning("can't read cube %s, ignoring" % cubepath)
+                self._cube0 = False
+        return self._cube0 if self._cube0 else None
+
+    def _deletedCube(self):
+        if self._deletedCube0 is None:
+            self._deletedCube0 = self._newCube()
+            deletedCubepath = self._cubepath(deleted=True)
+            try:
+                if os.path.exists(deletedCubepath):
+                    # if deleted cube is older than cache, remove it
+                    if os.stat(deletedCubepath).st_mtime < os.stat(self._cubepath()).st_mtime:
+                        os.remove(deletedCubepath)
+                    else:
+                        with open(deletedCubepath, 'rb') as f:
+                            self._deletedCube0 = AggregateCube.fromFile(f)
+            except IOError:
+                warning("can't read deleted cube %s, ignoring" % deletedCubepath)
+        return self._deletedCube0
+
+    def delete(self, filespec):
+        """Deletion from the top level of the cache, which we record in the cube."""
+        cube = self._cube()
+        if cube is not None:
+            cube.remove(filespec)
+            self._deletedCube().add(filespec)
+            self._ctx.pendingCaches.add(self)
+
+    def saveDeletions(self):
+        deletedCubepath = self._cubepath(deleted=True)
+        try:
+            if not os.path.exists(self._deltadir):
+                os.makedirs(self._deltadir)
+            with open(deletedCubepath, 'wb') as f:
+                self._deletedCube().write(f)
+        except IOError:
+            warning("can't write deleted cube %s, ignoring" % deletedCubepath)
+
+    def update(self, full=False):
+        # incremental update builds in staging, then merges only what changed
+        incremental = 'incrementalupdate' in self._attrs and self._cachestore == 'directory' and not full
+        if incremental and 'stagingdir' not in self._attrs:
+            # build on the local filesystem, so only what changed is written to the cache filesystem
+            self._staging0 = tempfile.mkdtemp(prefix="filebutler-%s-" % self.name)
+        # nothing being built may use the previous index or results
+        self._infoIndex0 = False
+        self._resultCache0 = False
+        if self._cachestore == 'sqlite':
+            cache = SqliteFilesetCache(self, self._path, self._deltadir, self._ctx, self._attrs)
+        elif self._cachestore == 'packed' or incremental:
+            cache = self._newcache(self, self._stagingpath(), self._deltadir, self._ctx, self._attrs, FilesetSelector(), 0, DirectoryStore())
+        else:
+            cache = self._cache()
+        cubepath = self._cubepath()
         try:
+            # remove any previous cube and info index first, so they're never stale
+            if os.path.exists(cubepath):
+                os.remove(cubepath)
+            if os.path.exists(self._infoindexpath()):
+                os.remove(self._infoindexpath())
+            # results for leaves left in place by an incremental update remain valid
+            if not incremental and os.path.exists(self._resultspath()):
+                os.remove(self._resultspath())
+            if not os.path.exists(self._path):
+                os.makedirs(self._path)
+            # remove anything left from other stores
+            if self._cachestore != 'packed' and os.path.exists(self._packpath()):
+                os.remove(self._packpath())
+            if self._cachestore != 'sqlite' and os.path.exists(os.path.join(self._path, "cache.db")):
+                os.remove(os.path.join(self._path, "cache.db"))
+            if self._cachestore != 'directory' and os.path.exists(os.path.join(self._path, "info")):
+                self._newcache(None, self._path, self._deltadir, self._ctx, self._attrs, FilesetSelector(), 0, DirectoryStore()).purge()
             cache.create()
             self._symlinks.purge()
         except OSError as e:
             if e.errno == errno.EACCES or e.errno == errno.EPERM:
                 # not ours to update, so silently do nothing
                 warning("can't update system cache %s" % self.name)
+                # left as it was, so the index and results remain valid
+                self._infoIndex0 = None
+                self._resultCache0 = None
+                if self._staging0 is not None:
+                    shutil.rmtree(self._staging0)
+                    self._staging0 = None
                 return
-        for filespec in self._fileset.select():
-            cache.add(filespec)
-            if filespec.target is not None:
-                self._symlinks.add(filespec.path, filespec.target)
-        # ensure from here on we don't hit open file problems
-        PooledFile.flushAll()
-        cache.finalize()
+        self._cube0 = None
+        self._deletedCube0 = None
+        cube = self._newCube()
+        raw0, stored0 = CacheCompression.written()
+        self._fileset.prepareUpdate(self._path, full)
+        if 'partitioned' in self._attrs and self._workers > 1 and len(self._caches) > 0 and self._cachestore != 'sqlite':
+            self._updatePartitioned(cache, cube)
+        else:
+            batch = []
+            for filespec in self._fileset.select():
+                batch.append(filespec)
+                if len(batch) == self.batchsize:
+                    cache.addBatch(batch)
+                    batch = []
+                cube.add(filespec)
+                if filespec.target is not None:
+                    self._symlinks.add(filespec.path, filespec.target)
+            if batch:
+                cache.addBatch(batch)
+            # ensure from here on we don't hit open file problems
+            PooledFile.flushAll()
+            if self._workers > 1:
+                with concurrent.futures.ProcessPoolExecutor(self._workers) as pool:
+                    cache.finalize(pool)
+            else:
+                cache.finalize()
+        with open(cubepath, 'wb') as f:
+            cube.write(f)
+        builtpath = self._stagingpath() if self._cachestore == 'packed' or incremental else self._path
+        # private caches are protected by directory permissions, which the index would bypass
+        if self._cachestore != 'sqlite' and 'private' not in self._attrs:
+            InfoIndex.write(builtpath, self._infoindexpath())
+        if self._compression != 'none':
+            raw, stored = CacheCompression.written()
+            self._reportCompression(raw - raw0, stored - stored0)
+        if self._cachestore == 'packed':
+            self._pack()
+        elif incremental:
+            self._merge()
+            self._staging0 = None
+            ResultCache.prune(self._path, self._resultspath())
+        # readers must reopen, with the new index and results
+        self._cache0 = None
+        self._infoIndex0 = None
+        self._resultCache0 = None
         # touch cache rootdir, to show updated
         try:
             os.utime(self._path, None)
@@ -130,6 +406,139 @@ class Cache(Fileset):
             pass
         progress_stderr("updated %s\n" % self.name)
 
+    def _reportCompression(self, rawSize, storedSize):
+        """Report the compression ratio of the filelists and info files written."""
+        if storedSize > 0:
+            progress_stderr("cache %s compressed with %s from %s to %s, ratio %.1f\n" % (self.name, self._compression, size2str(rawSize), size2str(storedSize), float(rawSize) / storedSize))
+
+    def _pack(self):
+        """Pack the cache built in the staging directory, replacing any previous one."""
+        verbose_stderr("cache %s packing\n" % self.name)
+        packpath = self._packpath()
+        staging = self._stagingpath()
+        PackedStore.pack(staging, packpath + ".new")
+        os.rename(packpath + ".new", packpath)
+        shutil.rmtree(staging)
+
+    @classmethod
+    def _readInfo(cls, path):
+        """Return the info at path as an object, or None if there is none."""
+        try:
+            with open(path, 'rb') as f:
+                return json.load(CacheCompression.reader(f))
+        except (IOError, ValueError):
+            return None
+
+    @classmethod
+    def _replace(cls, src, dst):
+        """Replace dst with src, which may be on another filesystem, so readers never see it partly written."""
+        shutil.move(src, dst + ".new")
+        os.rename(dst + ".new", dst)
+
+    def _merge(self):
+        """Merge the cache built in the staging directory into the existing one, replacing only what changed.
+
+        A leaf is unchanged if its filelist has the same digest as before,
+        and an internal fileset if its info is the same.  Anything with
+        pending deletions is replaced anyway, so they become obsolete just
+        as for a full update.
+        """
+        verbose_stderr("cache %s merging\n" % self.name)
+        staging = self._stagingpath()
+        nLeaves = 0
+        nReplaced = 0
+        for root, dirs, files in os.walk(staging):
+            rel = os.path.relpath(root, staging)
+            path = os.path.normpath(os.path.join(self._path, rel))
+            deltadir = os.path.normpath(os.path.join(self._deltadir, rel))
+            if os.path.exists(path):
+                # remove filesets which no longer exist
+                for x in listdir(path):
+                    if x.startswith('_') and x not in dirs:
+                        shutil.rmtree(os.path.join(path, x))
+            else:
+                os.makedirs(path)
+            info = self._readInfo(os.path.join(root, "info"))
+            info0 = self._readInfo(os.path.join(path, "info"))
+            pending = os.path.exists(os.path.join(deltadir, "deleted.info"))
+            if 'filelist' in files:
+                nLeaves += 1
+                unchanged = (info is not None and info0 is not None and
+                             info.get('digest') is not None and info.get('digest') == info0.get('digest') and
+                             os.path.exists(os.path.join(path, "filelist")))
+                if not unchanged or pending:
+                    # filelist first, so the info is never newer than it
+                    self._replace(os.path.join(root, "filelist"), os.path.join(path, "filelist"))
+                    self._replace(os.path.join(root, "info"), os.path.join(path, "info"))
+                    nReplaced += 1
+            elif 'info' in files:
+                if info is None or info != info0 or pending:
+                    self._replace(os.path.join(root, "info"), os.path.join(path, "info"))
+                if os.path.exists(os.path.join(path, "filelist")):
+                    # was a leaf, before the cache structure changed
+                    os.remove(os.path.join(path, "filelist"))
+        shutil.rmtree(staging)
+        progress_stderr("cache %s replaced %d of %d leaves\n" % (self.name, nReplaced, nLeaves))
+
+    def _updatePartitioned(self, cache, cube):
+        """Update the cache, with the children of the top level partitioned across worker processes.
+
+        Each worker builds and finalizes the disjoint subtrees for its
+        partition, while the info for the top level is accumulated here,
+        so the result is just as for a serial update.
+        """
+        verbose_stderr("cache %s building with %d workers\n" % (self.name, self._workers))
+        mp = multiprocessing.get_context('fork')
+        conns = []
+        workers = []
+        for i in range(self._workers):
+            # filespecs are sent to the worker, and the sizes written compressed sent back
+            conn, workerConn = mp.Pipe()
+            worker = mp.Process(target=_buildPartition, args=(cache, workerConn))
+            worker.start()
+            workerConn.close()
+            conns.append(conn)
+            workers.append(worker)
+        batches = [[] for i in range(self._workers)]
+        batchsize = 1024
+        added = False
+        try:
+            for filespec in self._fileset.select():
+                added = True
+                cache.addInfo(filespec)
+                cube.add(filespec)
+                i = hash(cache.childKey(filespec)) % self._workers
+                batch = batches[i]
+                batch.append((filespec.dataset, filespec.path, filespec.user, filespec.group, filespec.size, filespec.mtime, filespec.perms))
+                if len(batch) == batchsize:
+                    conns[i].send(batch)
+                    batches[i] = []
+                if filespec.target is not None:
+                    self._symlinks.add(filespec.path, filespec.target)
+            for i in range(self._workers):
+                if batches[i]:
+                    conns[i].send(batches[i])
+                conns[i].send(None)
+            for conn in conns:
+                try:
+                    CacheCompression.account(*conn.recv())
+                except EOFError:
+                    # the worker failed, which is reported below
+                    pass
+        finally:
+            for conn in conns:
+                conn.close()
+            for worker in workers:
+                worker.join()
+        if any([worker.exitcode != 0 for worker in workers]):
+            raise CLIError("failed to update cache %s" % self.name)
+        PooledFile.flushAll()
+        # write top level info, only if a child did something
+        if added:
+            cache.writeInfo()
+        # the children were built only in the workers, so must be read afresh
+        self._cache0 = None
+
     def getCaches(self, caches):
         caches[self.name] = self
 
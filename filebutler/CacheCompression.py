@@ -0,0 +1,205 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import struct
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class _Compressor(io.RawIOBase):
+    """Raw writer compressing onto a file, which is finished with the trailer when closed."""
+
+    def __init__(self, f, compressor):
+        self._f = f
+        self._compressor = compressor
+        self._size = 0
+        if hasattr(compressor, 'begin'):
+            # lz4 frames need beginning
+            self._f.write(compressor.begin())
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._size += len(b)
+        self._f.write(self._compressor.compress(bytes(b)))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self._f.write(self._compressor.flush())
+            self._f.write(CacheCompression._trailer.pack(self._size, CacheCompression.magic))
+            CacheCompression.account(self._size, self._f.tell())
+            self._f.close()
+        super(self.__class__, self).close()
+
+class _Decompressor(io.RawIOBase):
+    """Raw reader decompressing from a file, which is positioned just after the header."""
+
+    def __init__(self, f, newDecompressor):
+        self._f = f
+        self._newDecompressor = newDecompressor
+        self._start = f.tell()
+        self._rewind()
+
+    def _rewind(self):
+        self._decompressor = self._newDecompressor()
+        self._buf = b''
+        self._offset = 0
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset == len(self._buf):
+            if self._decompressor.eof:
+                return 0
+            data = self._f.read(CacheCompression.chunksize)
+            if not data:
+                raise IOError("truncated compressed file")
+            self._buf = self._decompressor.decompress(data)
+            self._offset = 0
+        n = min(len(b), len(self._buf) - self._offset)
+        b[:n] = self._buf[self._offset:self._offset + n]
+        self._offset += n
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Seek by decompressing from the start, so only absolute positions are supported."""
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("only absolute seek in compressed file")
+        if offset < self._pos:
+            self._f.seek(self._start)
+            self._rewind()
+        b = bytearray(CacheCompression.chunksize)
+        while self._pos < offset:
+            if self.readinto(memoryview(b)[:min(len(b), offset - self._pos)]) == 0:
+                break
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+class CacheCompression(object):
+    """Compression of the leaf filelists and info files of a cache.
+
+    A compressed file begins with a magic number, format version, and
+    codec, then the compressed contents as a single stream, and finally
+    a trailer giving the uncompressed size.  Files which don't begin
+    with the magic number are read as they are, so caches may be
+    migrated one at a time, simply by updating them.  Compressed files
+    are read as a stream, a chunk at a time.
+    """
+
+    magic = b'\0FBZ'
+    version = 1
+    chunksize = 64 * 1024
+
+    _header = struct.Struct('<4sHH')    # magic, version, codec
+    _trailer = struct.Struct('<Q4s')    # uncompressed size, magic
+
+    # index in this list is the codec in the header
+    codecs = ['none', 'zlib', 'lz4', 'zstd']
+
+    # totals for files written compressed in this process
+    rawWritten = 0
+    storedWritten = 0
+
+    @classmethod
+    def available(cls):
+        """Return the codecs which may be used here, as some depend on optional packages."""
+        return [name for name in cls.codecs if
+                name == 'lz4' and lz4 is not None or
+                name == 'zstd' and zstandard is not None or
+                name in ('none', 'zlib')]
+
+    @classmethod
+    def _newCompressor(cls, codec):
+        name = cls.codecs[codec]
+        if name == 'zlib':
+            return zlib.compressobj(1)
+        elif name == 'lz4':
+            return lz4.frame.LZ4FrameCompressor()
+        else:
+            return zstandard.ZstdCompressor(level=1).compressobj()
+
+    @classmethod
+    def _newDecompressor(cls, codec):
+        name = cls.codecs[codec] if codec < len(cls.codecs) else None
+        if name == 'zlib':
+            return zlib.decompressobj
+        elif name == 'lz4' and lz4 is not None:
+            return lz4.frame.LZ4FrameDecompressor
+        elif name == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj
+        else:
+            raise IOError("unsupported compression codec %s" % (name if name is not None else codec))
+
+    @classmethod
+    def reader(cls, f):
+        """Return a stream of the contents of binary file f, decompressing if required."""
+        header = f.read(cls._header.size)
+        if len(header) == cls._header.size and header.startswith(cls.magic):
+            magic, version, codec = cls._header.unpack(header)
+            if version != cls.version:
+                raise IOError("unsupported compressed file version %d" % version)
+            return io.BufferedReader(_Decompressor(f, cls._newDecompressor(codec)), cls.chunksize)
+        else:
+            f.seek(0)
+            return f
+
+    @classmethod
+    def account(cls, raw, stored):
+        """Add the uncompressed and stored sizes of files written compressed to the totals."""
+        cls.rawWritten += raw
+        cls.storedWritten += stored
+
+    @classmethod
+    def written(cls):
+        """Return the totals of the uncompressed and stored sizes of files written compressed."""
+        return cls.rawWritten, cls.storedWritten
+
+    def __init__(self, name='none'):
+        self.name = name
+        self._codec = self.__class__.codecs.index(name)
+
+    def open(self, path, mode='w'):
+        """Open path for writing, compressed unless codec is none, in binary or text mode as given."""
+        if self.name == 'none':
+            return open(path, mode)
+        cls = self.__class__
+        f = open(path, 'wb')
+        f.write(cls._header.pack(cls.magic, cls.version, self._codec))
+        buffered = io.BufferedWriter(_Compressor(f, cls._newCompressor(self._codec)), cls.chunksize)
+        if 'b' in mode:
+            return buffered
+        else:
+            return io.TextIOWrapper(buffered, encoding='utf-8')
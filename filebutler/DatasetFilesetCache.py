@@ -23,12 +23,12 @@ from .util import debug_log
 
 class DatasetFilesetCache(FilesetCache):
 
-    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next):
-        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next)
+    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next, store):
+        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next, store)
         self._datasets = {}        # of fileset, indexed by dataset
 
         # load stubs for all datasets found
-        if os.path.exists(self._path):
+        if self._store.exists(self._path):
             for d in self.children():
                 self._datasets[d] = None # stub
 
@@ -55,5 +55,5 @@ class DatasetFilesetCache(FilesetCache):
         self.purge()
         self._datasets = {}
 
-    def filesetFor(self, filespec):
-        return self._fileset(filespec.dataset)
+    def childKey(self, filespec):
+        return filespec.dataset
@@ -0,0 +1,36 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+
+from .PooledFile import PooledFile, listdir
+
+class DirectoryStore(object):
+    """Store for reading a cache laid out as a directory tree, one directory per fileset."""
+
+    def listdir(self, path):
+        return listdir(path)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def mtime(self, path):
+        return os.stat(path).st_mtime
+
+    def open(self, path, mode='r'):
+        return PooledFile(path, mode)
@@ -0,0 +1,74 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import tempfile
+
+class ExternalSort(object):
+    """Sort of text lines in bounded memory.
+
+    Lines are sorted in memory while they fit in the memory budget.
+    Beyond that, sorted runs are spilled to temporary files, which are
+    merged on reading.
+    """
+
+    lineoverhead = 128          # approximate memory per line beyond its text
+    maxruns = 64                # maximum number of runs merged at once
+
+    def __init__(self, key, budget, tmpdir=None):
+        self._key = key
+        self._budget = budget
+        self._tmpdir = tmpdir
+        self.nRuns = 0          # number of runs spilled, for reporting
+
+    def _spill(self, lines):
+        run = tempfile.TemporaryFile(mode='w+', dir=self._tmpdir)
+        run.writelines(lines)
+        run.seek(0)
+        self.nRuns += 1
+        return run
+
+    def _merge(self, runs):
+        try:
+            for line in heapq.merge(*runs, key=self._key):
+                yield line
+        finally:
+            for run in runs:
+                run.close()
+
+    def sort(self, lines):
+        """Read all lines, and return an iterator over them in sorted order."""
+        runs = []
+        chunk = []
+        used = 0
+        for line in lines:
+            chunk.append(line)
+            used += len(line) + self.lineoverhead
+            if used > self._budget:
+                chunk.sort(key=self._key)
+                runs.append(self._spill(chunk))
+                chunk = []
+                used = 0
+                if len(runs) == self.maxruns:
+                    # merge what we have, to limit open files
+                    runs = [self._spill(self._merge(runs))]
+        chunk.sort(key=self._key)
+        if not runs:
+            return iter(chunk)
+        if chunk:
+            runs.append(self._spill(chunk))
+        return self._merge(runs)
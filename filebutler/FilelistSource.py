@@ -0,0 +1,132 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import io
+import lzma
+import os
+import shutil
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .util import warning
+
+class FilelistSource(object):
+    """A source filelist, opened for reading as a stream of text lines.
+
+    The source is a plain file, or a compressed file, decompressed through
+    a pipe from a parallel external decompressor where one is installed,
+    or else in Python, or a command prefixed with !, whose output is read
+    through a pipe.  Either way, reading overlaps with whatever consumes
+    the lines.
+    """
+
+    # external decompressors by suffix, in order of preference
+    decompressors = {
+        '.gz':  [['pigz', '-dc'], ['gzip', '-dc']],
+        '.xz':  [['xz', '-dc', '-T0']],
+        '.zst': [['zstd', '-dc', '-T0']],
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._command = path[1:] if path.startswith('!') else None
+        self._suffix = None
+        if self._command is None:
+            for suffix in self.__class__.decompressors:
+                if path.endswith(suffix):
+                    self._suffix = suffix
+        self._file = None
+        self._proc = None
+        self._stream = None
+        self._size = None
+
+    @property
+    def plain(self):
+        """Whether the source is a plain file, so may be read in byte ranges."""
+        return self._command is None and self._suffix is None
+
+    def size(self):
+        """Return the size of the file, or None for a command, raising OSError if it's unreadable."""
+        if self._command is None:
+            self._size = os.stat(self.path).st_size
+        return self._size
+
+    def fraction(self):
+        """Return the fraction of the file read so far, as compressed bytes, or None for a command."""
+        if self._file is None or not self._size:
+            return None
+        # the file offset is shared with any external decompressor
+        return os.lseek(self._file.fileno(), 0, os.SEEK_CUR) * 1.0 / self._size
+
+    def _decompressor(self):
+        for cmd in self.__class__.decompressors[self._suffix]:
+            if shutil.which(cmd[0]) is not None:
+                return cmd
+        return None
+
+    def __enter__(self):
+        if self._command is not None:
+            self._proc = subprocess.Popen(self._command, shell=True, stdout=subprocess.PIPE)
+            self._stream = io.TextIOWrapper(self._proc.stdout)
+        elif self._suffix is None:
+            self._file = open(self.path)
+            self._stream = self._file
+        else:
+            self.size()
+            self._file = open(self.path, 'rb')
+            cmd = self._decompressor()
+            if cmd is not None:
+                self._proc = subprocess.Popen(cmd, stdin=self._file, stdout=subprocess.PIPE)
+                self._stream = io.TextIOWrapper(self._proc.stdout)
+            elif self._suffix == '.gz':
+                self._stream = io.TextIOWrapper(gzip.GzipFile(fileobj=self._file))
+            elif self._suffix == '.xz':
+                self._stream = io.TextIOWrapper(lzma.LZMAFile(self._file))
+            elif zstandard is not None:
+                try:
+                    # files may have many frames, e.g. from pzstd or when concatenated
+                    reader = zstandard.ZstdDecompressor().stream_reader(self._file, read_across_frames=True)
+                except TypeError:
+                    self._file.close()
+                    self._file = None
+                    raise IOError("zstandard package too old to read all frames of %s, install zstd or zstandard 0.19 or later" % self.path)
+                self._stream = io.TextIOWrapper(io.BufferedReader(reader))
+            else:
+                self._file.close()
+                self._file = None
+                raise IOError("no zstd decompressor for %s, install zstd or the zstandard package" % self.path)
+        return self._stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._proc is not None and exc_type is not None:
+            # reading abandoned, so don't leave the process running
+            self._proc.terminate()
+        self._stream.close()
+        if self._file is not None and self._file is not self._stream:
+            self._file.close()
+        if self._proc is not None:
+            status = self._proc.wait()
+            if status != 0 and exc_type is None:
+                warning("reading filelist %s failed with exit status %d" % (self.path, status))
+        self._file = None
+        self._proc = None
+        self._stream = None
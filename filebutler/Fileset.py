@@ -29,17 +29,31 @@ class Fileset(object):
         self.merge_info(acc, filter)
         return acc
 
+    def scan(self, filter=None):
+        """Like select, but in no particular order, which may be cheaper."""
+        for filespec in self.select(filter):
+            yield filespec
+
     def sorted(self, filter=None, sorter=None):
         if sorter is None:
             for filespec in self.select(filter):
                 yield filespec
         else:
+            # we sort everything anyway, so don't need path order from select
             filespecs = []
-            for filespec in self.select(filter):
+            for filespec in self.scan(filter):
                 filespecs.append(filespec)
-            filespecs.sort(key=sorter.key())
+            key = sorter.key()
+            filespecs.sort(key=lambda fs: (key(fs), fs.path))
             for filespec in filespecs:
                 yield filespec
 
+    def prepareUpdate(self, path, full):
+        """Prepare for update-cache to select everything, with a directory for state kept between updates.
+
+        Unless full is true, that state may be used to avoid work.
+        """
+        pass
+
     def delete(self, filespec):
         pass
@@ -15,9 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import os.path
 import shutil
 
+from .CacheCompression import CacheCompression
 from .FilesetInfoAccumulator import FilesetInfoAccumulator
 from .FilespecMerger import FilespecMerger
 from .PooledFile import listdir
@@ -26,7 +28,7 @@ from .util import debug_log, verbose_stderr, warning
 class FilesetCache(object):
     """FilesetCache is a base class."""
 
-    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next):
+    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next, store):
         self._parent = parent
         self._path = path
         self._deltadir = deltadir
@@ -34,8 +36,14 @@ class FilesetCache(object):
         self._attrs = attrs
         self._sel = sel
         self._next = next
+        self._store = store     # for reading
+        self._index = parent.infoIndex() if parent is not None else None
+        self._results = parent.resultCache() if parent is not None else None
+        self._compression = CacheCompression(attrs['cachecompression'][0] if 'cachecompression' in attrs else 'none')
         self._fileinfo = None
-        self._deletedInfo = FilesetInfoAccumulator(self._attrs)
+        self._deletedInfo = FilesetInfoAccumulator(self._attrs, self._sel)
+        self._pending = 0       # children not yet finalized
+        self._finalizeParent = None
 
     def __hash__(self):
         """For storage in sets."""
@@ -45,6 +53,14 @@ class FilesetCache(object):
         """For storage in sets."""
         return self is other
 
+    def infoIndex(self):
+        """Return the info index for the cache, or None if there isn't one."""
+        return self._index
+
+    def resultCache(self):
+        """Return the result cache for the cache, or None if there isn't one."""
+        return self._results
+
     def _subpath(self, x):
         return os.path.join(self._path, '_' + str(x))
 
@@ -53,7 +69,7 @@ class FilesetCache(object):
 
     def children(self):
         """Child filesets are stored with a leading underscore, to leave room for metadata."""
-        for x in listdir(self._path):
+        for x in self._store.listdir(self._path):
             if x.startswith('_'):
                 yield x[1:]
 
@@ -88,6 +104,12 @@ class FilesetCache(object):
         for filespec in merger.merge():
             yield filespec
 
+    def scan(self, filter=None):
+        """Yield from each child in turn, with no merge."""
+        for f, f1 in self.filtered(filter):
+            for filespec in f.scan(f1):
+                yield filespec
+
     def merge_info(self, acc, filter=None):
         """Return whether merged from cache; otherwise caller will have to scan over filespecs."""
         #debug_log("FilesetCache(%s) merge_info\n" % self._path)
@@ -97,24 +119,30 @@ class FilesetCache(object):
                 #debug_log("FilesetCache(%s)::merge_info(None) reading info file\n" % self._path)
                 infofile = self.infopath()
                 deletedInfofile = self.infopath(deleted=True)
+                # the info index knows where deletions are, saving a stat here
+                pending = self._index.hasDeletedInfo(self._deltadir) if self._index is not None else os.path.exists(deletedInfofile)
                 try:
-                    if os.path.exists(deletedInfofile):
+                    if pending:
                         # if deleted filelist is older than cache, remove it
-                        if os.stat(deletedInfofile).st_mtime < os.stat(infofile).st_mtime:
+                        cacheMtime = self._index.mtime if self._index is not None else self._store.mtime(infofile)
+                        if os.stat(deletedInfofile).st_mtime < cacheMtime:
                             #debug_log("removing obsolete deleted infofile %s\n" % deletedInfofile)
                             os.remove(deletedInfofile)
                         else:
                             #debug_log("reading deleted infofile %s\n" % deletedInfofile)
                             with open(deletedInfofile, 'r') as f:
-                                self._deletedInfo = FilesetInfoAccumulator.fromFile(f, self._attrs)
+                                self._deletedInfo = FilesetInfoAccumulator.fromFile(f, self._attrs, self._sel)
                 except IOError:
                     warning("can't read deleted info %s, ignoring" % deletedInfofile)
-                    self._deletedInfo = FilesetInfoAccumulator(self._attrs)
-                try:
-                    with open(infofile, 'r') as f:
-                        self._fileinfo = FilesetInfoAccumulator.fromFile(f, self._attrs)
-                except IOError:
-                    warning("can't read info %s, ignoring" % infofile)
+                    self._deletedInfo = FilesetInfoAccumulator(self._attrs, self._sel)
+                if self._index is not None:
+                    self._fileinfo = self._index.info(self._path, self._attrs, self._sel)
+                if self._fileinfo is None:
+                    try:
+                        with self._store.open(infofile, 'rb') as f:
+                            self._fileinfo = FilesetInfoAccumulator.fromFile(CacheCompression.reader(f), self._attrs, self._sel)
+                    except IOError:
+                        warning("can't read info %s, ignoring" % infofile)
 
             if self._fileinfo is not None:
                 acc.accumulate(self._fileinfo)
@@ -134,15 +162,59 @@ class FilesetCache(object):
             #debug_log("FilesetCache(%s)::merge_info() baling\n" % self._path)
             return False
 
+    def filesetFor(self, filespec):
+        """Return the child fileset for filespec, as keyed by the subclass childKey method."""
+        return self._fileset(self.childKey(filespec))
+
     def add(self, filespec):
         if self._next is not None:
             self.filesetFor(filespec).add(filespec)
+        self.addInfo(filespec)
+
+    def addBatch(self, filespecs):
+        """Add filespecs grouped by child, with the info here updated once for the batch.
+
+        Return the info for just these filespecs, for the parent to accumulate.
+        """
+        groups = {}
+        childKey = self.childKey
+        for filespec in filespecs:
+            key = childKey(filespec)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [filespec]
+            else:
+                group.append(filespec)
+        batchInfo = FilesetInfoAccumulator(self._attrs, self._sel)
+        for key, group in groups.items():
+            batchInfo.accumulate(self._fileset(key).addBatch(group))
+        self.addBatchInfo(batchInfo)
+        return batchInfo
+
+    def addBatchInfo(self, batchInfo):
+        """Add the info for a batch to this fileset only."""
         if self._fileinfo is None:
-            self._fileinfo = FilesetInfoAccumulator(self._attrs)
+            self._fileinfo = FilesetInfoAccumulator(self._attrs, self._sel)
+        self._fileinfo.accumulate(batchInfo)
+
+    def addInfo(self, filespec):
+        """Add filespec to the info for this fileset only, not its children."""
+        if self._fileinfo is None:
+            self._fileinfo = FilesetInfoAccumulator(self._attrs, self._sel)
         self._fileinfo.add(filespec)
 
-    def finalize(self):
+    def finalize(self, pool=None):
+        """Finalize writing the cache, with the leaves finalized in pool if given."""
         #debug_log("FilesetCache::finalize(%s)\n" % self._path)
+        if pool is not None:
+            futures = {}
+            self._submitFinalize(pool, futures)
+            for future in concurrent.futures.as_completed(futures):
+                # written in the worker, so not yet in the totals here
+                CacheCompression.account(*future.result())
+                futures[future]._finalizeDone()
+            return
+
         finalized = False
         if self._next is not None:
             for f, f1 in self.filtered(None):
@@ -152,9 +224,39 @@ class FilesetCache(object):
 
         # write info file, only if a child did something
         if self._next is None or finalized:
-            with open(self.infopath(), 'w') as infofile:
-                if self._fileinfo is not None:
-                    self._fileinfo.write(infofile)
+            self.writeInfo()
+
+    def _submitFinalize(self, pool, futures, parent=None):
+        """Submit finalization of the leaves to pool, with the futures mapped to their leaves."""
+        self._finalizeParent = parent
+        children = [f for f, f1 in self.filtered(None)]
+        self._pending = len(children)
+        for f in children:
+            f._submitFinalize(pool, futures, self)
+        if len(children) == 0:
+            self._finalizeDone()
+
+    def _finalizeDone(self):
+        """Called when this fileset is finalized, so its parent info may be written when ready."""
+        if self._finalizeParent is not None:
+            self._finalizeParent._childFinalized()
+
+    def _childFinalized(self):
+        self._pending -= 1
+        # write info file only once all children are done
+        if self._pending == 0:
+            self.writeInfo()
+            self._finalizeDone()
+
+    def finalizeChildren(self, keys):
+        """Finalize just the children with the given keys, as built for a partition of the cache."""
+        for key in keys:
+            self._fileset(key).finalize()
+
+    def writeInfo(self):
+        with self._compression.open(self.infopath(), 'w') as infofile:
+            if self._fileinfo is not None:
+                self._fileinfo.write(infofile)
 
     def delete(self, filespec):
         #debug_log("FilesetCache(%s)::delete %s\n" % (self._path, filespec.path))
@@ -179,4 +281,4 @@ class FilesetCache(object):
                     self._deletedInfo.write(f)
             except IOError:
                 warning("can't write deleted info %s, ignoring" % deletedInfofile)
-                self._deletedInfo = FilesetInfoAccumulator(self._attrs)
+                self._deletedInfo = FilesetInfoAccumulator(self._attrs, self._sel)
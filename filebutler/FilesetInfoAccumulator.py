@@ -14,42 +14,70 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
-
 import json
 
 from .util import str2size, size2str0, warning
 from .Buckets import Buckets
 from .FilesetInfo import FilesetInfo
+from .FilesetSelector import FilesetSelector
+from .ZoneMap import ZoneMap
 
 class FilesetInfoAccumulator(object):
+    """Totals for a fileset, broken down by user, dataset, and size bucket.
+
+    Any of these fixed by the selector of the fileset, as for filesets
+    beneath a user, dataset, or size cache, are not tracked, nor written
+    out, but reconstructed from the total when needed.
+    """
+
+    _buckets = {}       # shared, indexed by sizebuckets attribute
+
+    @classmethod
+    def fromFile(cls, f, attrs, sel=None):
+        return cls.fromDict(json.load(f), attrs, sel)
 
     @classmethod
-    def fromFile(cls, f, attrs):
-        obj = json.load(f)
-        acc = cls(attrs)
+    def fromDict(cls, obj, attrs, sel=None):
+        acc = cls(attrs, sel)
         acc._total = FilesetInfo.fromDict(obj['total'])
 
-        users = obj['users']
-        for user in users:
-            acc._users[user] = FilesetInfo.fromDict(users[user])
+        if acc._users is not None:
+            users = obj.get('users', {})
+            for user in users:
+                acc._users[user] = FilesetInfo.fromDict(users[user])
 
-        datasets = obj['datasets']
-        for dataset in datasets:
-            acc._datasets[dataset] = FilesetInfo.fromDict(datasets[dataset])
+        if acc._datasets is not None:
+            datasets = obj.get('datasets', {})
+            for dataset in datasets:
+                acc._datasets[dataset] = FilesetInfo.fromDict(datasets[dataset])
 
-        sizes = obj['sizes']
-        for i in range(min(len(acc._sizes), len(sizes))):
-            if sizes[i] is not None:
-                acc._sizes[i] = FilesetInfo.fromDict(sizes[i])
+        if acc._sizes is not None:
+            sizes = obj.get('sizes', [])
+            for i in range(min(len(acc._sizes), len(sizes))):
+                if sizes[i] is not None:
+                    acc._sizes[i] = FilesetInfo.fromDict(sizes[i])
+
+        if 'zone' in obj:
+            acc.zone = ZoneMap.fromDict(obj['zone'])
+
+        if 'digest' in obj:
+            acc.digest = obj['digest']
 
         return acc
 
-    def __init__(self, attrs):
+    def __init__(self, attrs, sel=None):
+        self._sel = sel if sel is not None else FilesetSelector()
         self._total = FilesetInfo()
-        self._users = {}
-        self._datasets = {}
-        self._sizebuckets = Buckets([str2size(s) for s in attrs['sizebuckets']] if 'sizebuckets' in attrs else [])
-        self._sizes = [None] * self._sizebuckets.len
+        sizebuckets = tuple(attrs['sizebuckets']) if 'sizebuckets' in attrs else ()
+        if sizebuckets not in self._buckets:
+            self._buckets[sizebuckets] = Buckets([str2size(s) for s in sizebuckets])
+        self._sizebuckets = self._buckets[sizebuckets]
+        # None for fixed by the selector
+        self._users = {} if self._sel.owner is None else None
+        self._datasets = {} if self._sel.dataset is None else None
+        self._sizes = [None] * self._sizebuckets.len if self._sel.sizebucket is None else None
+        self.zone = None        # only for leaves of the cache
+        self.digest = None      # of the filelist, only for leaves of incrementally updated caches
 
     @property
     def nFiles(self):
@@ -59,50 +87,80 @@ class FilesetInfoAccumulator(object):
     def totalSize(self):
         return self._total.totalSize
 
+    def _userItems(self):
+        """Return (user, info) for each user, including any fixed by the selector."""
+        if self._users is not None:
+            return list(self._users.items())
+        elif self._total.nFiles != 0:
+            return [(self._sel.owner, self._total)]
+        else:
+            return []
+
+    def _datasetItems(self):
+        """Return (dataset, info) for each dataset, including any fixed by the selector."""
+        if self._datasets is not None:
+            return list(self._datasets.items())
+        elif self._total.nFiles != 0:
+            return [(self._sel.dataset, self._total)]
+        else:
+            return []
+
+    def _sizeItems(self):
+        """Return (index, info) for each size bucket with files, including any fixed by the selector."""
+        if self._sizes is not None:
+            return [(i, self._sizes[i]) for i in range(len(self._sizes)) if self._sizes[i] is not None]
+        elif self._total.nFiles != 0:
+            return [(self._sizebuckets.index(self._sel.sizebucket), self._total)]
+        else:
+            return []
+
     def add(self, filespec):
         self._total.add(1, filespec.size)
 
         # user
-        if filespec.user in self._users:
-            user = self._users[filespec.user]
-        else:
-            user = FilesetInfo()
-            self._users[filespec.user] = user
-        user.add(1, filespec.size)
+        if self._users is not None:
+            if filespec.user in self._users:
+                user = self._users[filespec.user]
+            else:
+                user = FilesetInfo()
+                self._users[filespec.user] = user
+            user.add(1, filespec.size)
 
         # dataset
-        if filespec.dataset in self._datasets:
-            dataset = self._datasets[filespec.dataset]
-        else:
-            dataset = FilesetInfo()
-            self._datasets[filespec.dataset] = dataset
-        dataset.add(1, filespec.size)
+        if self._datasets is not None:
+            if filespec.dataset in self._datasets:
+                dataset = self._datasets[filespec.dataset]
+            else:
+                dataset = FilesetInfo()
+                self._datasets[filespec.dataset] = dataset
+            dataset.add(1, filespec.size)
 
         # size
-        i = self._sizebuckets.indexContaining(filespec.size)
-        sizes0 = self._sizes[i]
-        if sizes0 is None:
-            sizes0 = FilesetInfo()
-            self._sizes[i] = sizes0
-        sizes0.add(1, filespec.size)
+        if self._sizes is not None:
+            i = self._sizebuckets.indexContaining(filespec.size)
+            sizes0 = self._sizes[i]
+            if sizes0 is None:
+                sizes0 = FilesetInfo()
+                self._sizes[i] = sizes0
+            sizes0.add(1, filespec.size)
 
     def accumulateInfo(self, info, sel):
         self._total.add(info.nFiles, info.totalSize)
-        if sel.owner is not None:
+        if sel.owner is not None and self._users is not None:
             if sel.owner not in self._users:
                 user0 = FilesetInfo()
                 self._users[sel.owner] = user0
             else:
                 user0 = self._users[sel.owner]
             user0.add(info.nFiles, info.totalSize)
-        if sel.dataset is not None:
+        if sel.dataset is not None and self._datasets is not None:
             if sel.dataset not in self._datasets:
                 dataset0 = FilesetInfo()
                 self._datasets[sel.dataset] = dataset0
             else:
                 dataset0 = self._datasets[sel.dataset]
             dataset0.add(info.nFiles, info.totalSize)
-        if sel.sizebucket is not None:
+        if sel.sizebucket is not None and self._sizes is not None:
             i = self._sizebuckets.index(sel.sizebucket)
             sizes0 = self._sizes[i]
             if sizes0 is None:
@@ -112,25 +170,24 @@ class FilesetInfoAccumulator(object):
 
     def accumulate(self, acc):
         self._total.add(acc.nFiles, acc.totalSize)
-        for user in acc._users:
-            user1 = acc._users[user]
-            if user not in self._users:
-                user0 = FilesetInfo()
-                self._users[user] = user0
-            else:
-                user0 = self._users[user]
-            user0.add(user1.nFiles, user1.totalSize)
-        for dataset in acc._datasets:
-            dataset1 = acc._datasets[dataset]
-            if dataset not in self._datasets:
-                dataset0 = FilesetInfo()
-                self._datasets[dataset] = dataset0
-            else:
-                dataset0 = self._datasets[dataset]
-            dataset0.add(dataset1.nFiles, dataset1.totalSize)
-        for i in range(len(acc._sizes)):
-            sizes1 = acc._sizes[i]
-            if sizes1 is not None:
+        if self._users is not None:
+            for user, user1 in acc._userItems():
+                if user not in self._users:
+                    user0 = FilesetInfo()
+                    self._users[user] = user0
+                else:
+                    user0 = self._users[user]
+                user0.add(user1.nFiles, user1.totalSize)
+        if self._datasets is not None:
+            for dataset, dataset1 in acc._datasetItems():
+                if dataset not in self._datasets:
+                    dataset0 = FilesetInfo()
+                    self._datasets[dataset] = dataset0
+                else:
+                    dataset0 = self._datasets[dataset]
+                dataset0.add(dataset1.nFiles, dataset1.totalSize)
+        if self._sizes is not None:
+            for i, sizes1 in acc._sizeItems():
                 if self._sizes[i] is None:
                     sizes0 = FilesetInfo()
                     self._sizes[i] = sizes0
@@ -140,21 +197,21 @@ class FilesetInfoAccumulator(object):
 
     def decumulateInfo(self, info, sel):
         self._total.remove(info.nFiles, info.totalSize)
-        if sel.owner is not None:
+        if sel.owner is not None and self._users is not None:
             if sel.owner in self._users:
                 user0 = self._users[sel.owner]
                 user0.remove(info.nFiles, info.totalSize)
                 if user0.nFiles == 0:
                     # remove user, since no files left
                     self._users.pop(sel.owner, None)
-        if sel.dataset is not None:
+        if sel.dataset is not None and self._datasets is not None:
             if sel.dataset in self._datasets:
                 dataset0 = self._datasets[sel.dataset]
                 dataset0.remove(info.nFiles, info.totalSize)
                 if dataset0.nFiles == 0:
                     # remove dataset, since no files left
                     self._datasets.pop(sel.dataset, None)
-        if sel.sizebucket is not None:
+        if sel.sizebucket is not None and self._sizes is not None:
             i = self._sizebuckets.index(sel.sizebucket)
             sizes0 = self._sizes[i]
             sizes0.remove(info.nFiles, info.totalSize)
@@ -164,34 +221,32 @@ class FilesetInfoAccumulator(object):
 
     def decumulate(self, acc):
         self._total.remove(acc.nFiles, acc.totalSize)
-        for user in acc._users:
-            user1 = acc._users[user]
-            if user not in self._users:
-                user0 = FilesetInfo()
-                self._users[user] = user0
-            else:
-                user0 = self._users[user]
-            user0.remove(user1.nFiles, user1.totalSize)
-        for dataset in acc._datasets:
-            dataset1 = acc._datasets[dataset]
-            if dataset not in self._datasets:
-                dataset0 = FilesetInfo()
-                self._datasets[dataset] = dataset0
-            else:
-                dataset0 = self._datasets[dataset]
-            dataset0.remove(dataset1.nFiles, dataset1.totalSize)
-        for i in range(len(acc._sizes)):
-            sizes0 = self._sizes[i]
-            sizes1 = acc._sizes[i]
-            if sizes1 is not None:
-                sizes0.remove(sizes1.nFiles, sizes1.totalSize)
+        if self._users is not None:
+            for user, user1 in acc._userItems():
+                if user not in self._users:
+                    user0 = FilesetInfo()
+                    self._users[user] = user0
+                else:
+                    user0 = self._users[user]
+                user0.remove(user1.nFiles, user1.totalSize)
+        if self._datasets is not None:
+            for dataset, dataset1 in acc._datasetItems():
+                if dataset not in self._datasets:
+                    dataset0 = FilesetInfo()
+                    self._datasets[dataset] = dataset0
+                else:
+                    dataset0 = self._datasets[dataset]
+                dataset0.remove(dataset1.nFiles, dataset1.totalSize)
+        if self._sizes is not None:
+            for i, sizes1 in acc._sizeItems():
+                self._sizes[i].remove(sizes1.nFiles, sizes1.totalSize)
 
     def fmt_total(self):
         return ["total %s" % str(self._total)]
 
     def fmt_users(self):
         lines = self.fmt_total()
-        for user in sorted(list(self._users.items()), key=lambda u: u[1].totalSize, reverse=True):
+        for user in sorted(self._userItems(), key=lambda u: u[1].totalSize, reverse=True):
             name = user[0]
             info = user[1]
             # exclude trivial small stuff
@@ -200,11 +255,11 @@ class FilesetInfoAccumulator(object):
         return lines
 
     def iterusers(self):
-        return iter(self._users.items())
+        return iter(self._userItems())
 
     def fmt_datasets(self):
         lines = self.fmt_total()
-        for dataset in sorted(list(self._datasets.items()), key=lambda u: u[1].totalSize, reverse=True):
+        for dataset in sorted(self._datasetItems(), key=lambda u: u[1].totalSize, reverse=True):
             name = dataset[0]
             info = dataset[1]
             # exclude trivial small stuff
@@ -214,23 +269,30 @@ class FilesetInfoAccumulator(object):
 
     def fmt_sizes(self):
         lines = self.fmt_total()
-        last = len(self._sizes) - 1
-        for i in range(last + 1):
-            if self._sizes[i] is not None:
-                info = self._sizes[i]
-                # exclude trivial small stuff
-                if info.totalSize > 1024:
-                    if i < last:
-                        interval = "%4s - %4s" % (size2str0(self._sizebuckets.bound(i)), size2str0(self._sizebuckets.bound(i + 1)))
-                    else:
-                        interval = "%4s +     " % size2str0(self._sizebuckets.bound(i))
-                    lines.append("%s  %s" % (interval, str(info)))
+        last = self._sizebuckets.len - 1
+        for i, info in self._sizeItems():
+            # exclude trivial small stuff
+            if info.totalSize > 1024:
+                if i < last:
+                    interval = "%4s - %4s" % (size2str0(self._sizebuckets.bound(i)), size2str0(self._sizebuckets.bound(i + 1)))
+                else:
+                    interval = "%4s +     " % size2str0(self._sizebuckets.bound(i))
+                lines.append("%s  %s" % (interval, str(info)))
         return lines
 
     def write(self, f):
-        json.dump({
+        obj = {
             'total': self._total,
-            'users': self._users,
-            'datasets': self._datasets,
-            'sizes': self._sizes,
-        }, f, default=lambda obj: obj.__dict__)
+        }
+        # any fixed by the selector are left for the reader to reconstruct
+        if self._users is not None:
+            obj['users'] = self._users
+        if self._datasets is not None:
+            obj['datasets'] = self._datasets
+        if self._sizes is not None:
+            obj['sizes'] = self._sizes
+        if self.zone is not None:
+            obj['zone'] = self.zone
+        if self.digest is not None:
+            obj['digest'] = self.digest
+        json.dump(obj, f, default=lambda obj: obj.__dict__)
@@ -15,15 +15,20 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
-import calendar
-import os
-import time
+import heapq
+import itertools
 
 class FilespecMerger(object):
-    """Merge filespecs from multiple iterators in order of path."""
+    """Merge filespecs from multiple iterators in order of path.
 
-    def __init__(self):
+    The iterators are merged using a heap keyed by path and iterator index,
+    so filespecs with equal paths are yielded in the order their iterators
+    were added.  Filespecs are pulled from each iterator in batches.
+    """
+
+    def __init__(self, batchsize=256):
         self._iters = []
+        self._batchsize = batchsize
 
     def add(self, iter):
         """Add an iterator, to be merged in with the others."""
@@ -31,30 +36,38 @@ class FilespecMerger(object):
 
     def merge(self):
         """Yield from all the iterators in order."""
-        # get initial value for each iterator
-        values = []
-        for iter in self._iters:
-            try:
-                value = next(iter)
-            except StopIteration:
-                value = None
-            values.append(value)
+        if len(self._iters) == 1:
+            # nothing to merge
+            for filespec in self._iters[0]:
+                yield filespec
+            return
+
+        batchsize = self._batchsize
+        batches = []            # current batch for each iterator
+        positions = []          # of next filespec in each batch
+        heap = []               # of (path, i, filespec)
+        for i in range(len(self._iters)):
+            batch = list(itertools.islice(self._iters[i], batchsize))
+            batches.append(batch)
+            positions.append(1)
+            if batch:
+                heap.append((batch[0].path, i, batch[0]))
+        heapq.heapify(heap)
 
         # merge least value each time until done
-        done = False
-        while not done:
-            # find min value
-            min_i = None
-            for i in range(len(values)):
-                if values[i] is not None and (min_i is None or values[i].path < values[min_i].path):
-                    min_i = i
-
-            if min_i is not None:
-                yield values[min_i]
-                # get next value for iterator which returned this one
-                try:
-                    values[min_i] = next(self._iters[min_i])
-                except StopIteration:
-                    values[min_i] = None
+        while heap:
+            _, i, filespec = heap[0]
+            yield filespec
+            # get next value for iterator which returned this one
+            batch = batches[i]
+            j = positions[i]
+            if j == len(batch):
+                batch = list(itertools.islice(self._iters[i], batchsize))
+                batches[i] = batch
+                j = 0
+            if batch:
+                value = batch[j]
+                positions[i] = j + 1
+                heapq.heapreplace(heap, (value.path, i, value))
             else:
-                done = True
+                heapq.heappop(heap)
@@ -17,6 +17,7 @@
 
 import datetime
 import fnmatch
+import json
 import re
 
 from .util import Giga, debug_log, liberal
@@ -55,6 +56,14 @@ class Filter(object):
         else:
             return cls(f0.owner, f0.dataset, None, f0.mtime, f0.notPaths, f0.regex)
 
+    @classmethod
+    def withNotPaths(cls, f0, notPaths):
+        """Return a copy of f0 with the given notPaths, or None if that leaves nothing specified."""
+        if f0.owner is None and f0.dataset is None and f0.sizeGeq is None and f0.mtime is None and notPaths == [] and f0.regex is None:
+            return None
+        else:
+            return cls(f0.owner, f0.dataset, f0.sizeGeq, f0.mtime, notPaths, f0.regex)
+
     def __init__(self, owner=None, dataset=None, sizeGeq=None, mtime=None, notPaths=[], regex=None):
         self.owner = owner
         self.dataset = dataset
@@ -85,6 +94,11 @@ class Filter(object):
             s = append(s, "regex:%s" % self.regex)
         return s
 
+    def key(self):
+        """Return a string identifying exactly what the filter selects, unlike str, which abbreviates."""
+        mtime = [self.mtime.before, self.mtime.after] if self.mtime is not None else None
+        return json.dumps([self.owner, self.dataset, self.sizeGeq, mtime, self.notPaths, self.regex])
+
     def intersect(self, f1):
         """Return a new filter which is the intersection of self with the parameter f1."""
         if f1 is None:
@@ -36,6 +36,11 @@ class FilterFileset(Fileset):
         for filespec in self._fileset.select(f1):
             yield filespec
 
+    def scan(self, filter=None):
+        f1 = self._filter.intersect(filter)
+        for filespec in self._fileset.scan(f1):
+            yield filespec
+
     def merge_info(self, acc, filter=None):
         f1 = self._filter.intersect(filter)
         #debug_log("FilterFileset(%s)::merge_info filter=(%s ^ %s = %s)\n" % (self.name, self._filter, filter, f1))
@@ -15,24 +15,92 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import errno
+import json
 import os
 import os.path
 import grp
 import pwd
 import re
 import stat
+import time
 
 from .CLIError import CLIError
 from .Fileset import Fileset
 from .Filespec import Filespec
-from .PooledFile import listdir
-from .util import filemode, verbose_stderr
+from .PooledFile import PooledFile
+from .util import filemode, verbose_stderr, debug_log, progress_stderr, warning, attrint
+
+def _scan(root, names=None):
+    """Return the entries of directory root as (name, lstat, symlink target, is directory), or None if too many open files.
+
+    If names are given, the directory is known to be unchanged, so isn't
+    listed, and just the named entries are lstat'ed.  This may run in a
+    worker thread, so leaves it to the caller to close pooled files,
+    which aren't thread safe.
+    """
+    if names is not None:
+        return _restat(root, names)
+    try:
+        with os.scandir(root) as it:
+            dirEntries = list(it)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            # ignore just-disappeared directory
+            return []
+        elif e.errno == errno.EMFILE:
+            return None
+        else:
+            raise
+    entries = []
+    for entry in dirEntries:
+        try:
+            s = entry.stat(follow_symlinks=False)
+            # the type is cached by the entry, so needs no further system call
+            target = os.readlink(entry.path) if entry.is_symlink() else None
+            entries.append((entry.name, s, target, entry.is_dir(follow_symlinks=False)))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # ignore just-disappeared path
+                continue
+            else:
+                raise
+    return entries
+
+def _restat(root, names):
+    """Return the entries of unchanged directory root, as for _scan."""
+    entries = []
+    for name in names:
+        path = os.path.join(root, name)
+        try:
+            s = os.lstat(path)
+            target = os.readlink(path) if stat.S_ISLNK(s.st_mode) else None
+            entries.append((name, s, target, stat.S_ISDIR(s.st_mode)))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # ignore just-disappeared path
+                continue
+            else:
+                raise
+    return entries
 
 class FindFileset(Fileset):
+    """Fileset of files found by walking a directory tree.
+
+    An incremental fileset keeps a manifest of the directories found by
+    update-cache, with their mtimes, inodes, and entries.  Entries are
+    only created or removed by changing the directory, which updates its
+    mtime, so a directory whose mtime is unchanged since the manifest was
+    written needn't be listed again, just its entries lstat'ed.
+    """
+
+    manifestVersion = 1
+    racyTime = 2    # seconds before scan within which a directory mtime can't be trusted
 
     @classmethod
-    def parse(cls, ctx, name, toks):
+    def parse(cls, ctx, name, toks, attrs):
         if len(toks) == 1:
             path = toks[0]
             match = '^'
@@ -43,9 +111,9 @@ class FindFileset(Fileset):
             replace = toks[2]
         else:
             raise CLIError("find requires path, and either both of match-re, replace-str or neither")
-        return cls(ctx, name, path, match, replace)
+        return cls(ctx, name, path, match, replace, attrint(attrs, 'findthreads', 1), 'incrementalfind' in attrs)
 
-    def __init__(self, ctx, name, path, match, replace):
+    def __init__(self, ctx, name, path, match, replace, threads=1, incremental=False):
         #print("FindFileset init '%s' '%s' '%s'" % (path, match, replace))
         super(self.__class__, self).__init__()
         self._ctx = ctx
@@ -53,46 +121,125 @@ class FindFileset(Fileset):
         self._path = path
         self._match = match
         self._replace = replace
+        self._threads = threads
+        self._incremental = incremental
+        self._manifestpath = None   # only when updating an incremental cache
+        self._full = False
 
     def description(self):
         return "%s directory %s" % (self.name, self._path)
 
+    def prepareUpdate(self, path, full):
+        if self._incremental:
+            self._manifestpath = os.path.join(path, "manifest")
+            self._full = full
+
+    def _readManifest(self):
+        """Return the manifest as a dictionary of (stamp, names) indexed by directory, empty if none."""
+        manifest = {}
+        if self._manifestpath is None or self._full or not os.path.exists(self._manifestpath):
+            return manifest
+        try:
+            with open(self._manifestpath) as f:
+                version = json.loads(f.readline())
+                if version == self.__class__.manifestVersion:
+                    for line in f:
+                        root, stamp, names = json.loads(line)
+                        manifest[root] = (stamp, names)
+        except (IOError, ValueError):
+            warning("can't read manifest %s, ignoring" % self._manifestpath)
+            manifest = {}
+        return manifest
+
+    def _entries(self, root, names, entries):
+        """Return the entries from _scan, scanning again if it hit too many open files."""
+        if entries is None:
+            debug_log("scandir failed for %s, close all pooled files\n" % root)
+            PooledFile.closeDescriptors()
+            entries = _scan(root, names)
+            if entries is None:
+                raise OSError(errno.EMFILE, os.strerror(errno.EMFILE), root)
+        return entries
+
+    def _walk(self):
+        """Yield each directory with its entries, breadth first, with directories scanned ahead by the threads."""
+        manifest = self._readManifest()
+        newManifest = None
+        if self._manifestpath is not None:
+            # readable only by update-cache, as it lists every file, which a private cache mustn't reveal
+            fd = os.open(self._manifestpath + ".new", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # in case left over from before, with other permissions
+            os.fchmod(fd, 0o600)
+            newManifest = os.fdopen(fd, 'w')
+            newManifest.write("%d\n" % self.__class__.manifestVersion)
+        racy = (time.time() - self.__class__.racyTime) * 1e9
+        nDirs = 0
+        nSkipped = 0
+        def stampOf(s):
+            """Return what shows whether a directory is unchanged."""
+            return [s.st_mtime_ns, s.st_ino]
+        def names(root, dirStamp):
+            """Return the names in root if unchanged since the manifest, otherwise None."""
+            if root in manifest:
+                stamp0, names0 = manifest[root]
+                if stamp0 is not None and stamp0 == dirStamp:
+                    return names0
+            return None
+        def scanned(root, dirStamp, entries):
+            if newManifest is not None:
+                # a directory changed just now might change again without its mtime changing
+                trusted = dirStamp is not None and dirStamp[0] < racy
+                newManifest.write("%s\n" % json.dumps([root, dirStamp if trusted else None, [x[0] for x in entries]]))
+            dirs.extend([(os.path.join(root, x[0]), stampOf(x[1])) for x in entries if x[3]])
+        try:
+            rootStamp = stampOf(os.stat(self._path))
+        except OSError:
+            rootStamp = None
+        dirs = collections.deque([(self._path, rootStamp)])
+        try:
+            if self._threads <= 1:
+                while dirs:
+                    root, dirStamp = dirs.popleft()
+                    names0 = names(root, dirStamp)
+                    entries = self._entries(root, names0, _scan(root, names0))
+                    nDirs += 1
+                    if names0 is not None:
+                        nSkipped += 1
+                    yield root, entries
+                    scanned(root, dirStamp, entries)
+            else:
+                with concurrent.futures.ThreadPoolExecutor(self._threads) as pool:
+                    pending = collections.deque()   # of (root, stamp, names, future), in breadth first order
+                    while dirs or pending:
+                        # limit how far ahead we scan, as each scanned directory is held in memory
+                        while dirs and len(pending) < 4 * self._threads:
+                            root, dirStamp = dirs.popleft()
+                            names0 = names(root, dirStamp)
+                            pending.append((root, dirStamp, names0, pool.submit(_scan, root, names0)))
+                        root, dirStamp, names0, future = pending.popleft()
+                        entries = self._entries(root, names0, future.result())
+                        nDirs += 1
+                        if names0 is not None:
+                            nSkipped += 1
+                        yield root, entries
+                        scanned(root, dirStamp, entries)
+        finally:
+            if newManifest is not None:
+                newManifest.close()
+        if newManifest is not None:
+            os.rename(self._manifestpath + ".new", self._manifestpath)
+            progress_stderr("fileset %s skipped listing %d of %d directories, unchanged since last update\n" % (self.name, nSkipped, nDirs))
+
     def select(self, filter=None):
         verbose_stderr("fileset %s scanning files under %s\n" % (self.name, self._path))
         pathlen = len(self._path) + (0 if self._path[-1] == '/' else 1)
-        dirs = [self._path]
+        match = re.compile(self._match)
         # can't use os.walk, as that fails if we hit too many open files
-        while dirs != []:
-            root = dirs[0]
+        for root, entries in self._walk():
             relroot = root[pathlen:]
-            dirs = dirs[1:]
-            try:
-                entries = listdir(root)
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    # ignore just-disappeared directory
-                    continue
-                else:
-                    raise
-
-            for x in entries:
-                xpath = os.path.join(root, x)
+            for x, s, target, isdir in entries:
                 xrel = os.path.join(relroot, x)
-                try:
-                    s = os.lstat(xpath)
-                except OSError as e:
-                    if e.errno == errno.ENOENT:
-                        # ignore just-disappeared path
-                        continue
-                    else:
-                        raise
-                if stat.S_ISDIR(s.st_mode):
-                    dirs.append(xpath)
-                if stat.S_ISLNK(s.st_mode):
-                    target = os.readlink(xpath)
-                else:
-                    target = None
-                path = re.sub(self._match, self._replace, xrel)
+                path = match.sub(self._replace, xrel)
                 filespec = Filespec(fileset=self,
                                     dataset=self._ctx.pathway.datasetFromPath(path),
                                     path=path,
@@ -0,0 +1,110 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import calendar
+import datetime
+import re
+import sys
+
+from .Localtime import Localtime
+
+class FindLsTokenizer(object):
+    """Tokenizes lines of find -ls output into Filespec fields.
+
+    Since there are very many lines, the work per line is kept to a
+    minimum.  The match regex is compiled once, or not used at all if
+    it simply adds a prefix, dates are looked up in a table memoized by
+    their fields, and user and group names are memoized as interned
+    strings.  The tokenizer is picklable, for use in worker processes.
+    """
+
+    def __init__(self, ctx, match, replace):
+        self._mapper = ctx.mapper
+        self._pathway = ctx.pathway
+        if match == '^' and '\\' not in replace:
+            self._prefix = replace
+            self._match = None
+        else:
+            self._prefix = None
+            self._match = re.compile(match)
+        self._replace = replace
+        self._localtime = Localtime()
+        self._monthNumbers = {}  # indexed by month_abbr, of 1 to 12
+        for i in range(12):
+            self._monthNumbers[calendar.month_abbr[i + 1]] = i + 1
+        self._today = datetime.datetime.today()
+        self._times = {}        # indexed by (month, day, year or None for time-of-day)
+        self._usernames = {}    # indexed by user field
+        self._groupnames = {}   # indexed by group field
+
+    def _t(self, month, day, yearOrTime):
+        """Return the time for the date fields, as found by find -ls."""
+        year = yearOrTime if len(yearOrTime) == 4 else None
+        key = (month, day, year)
+        t = self._times.get(key)
+        if t is None:
+            m = self._monthNumbers[month]
+            if year is not None:
+                y = int(year)
+            elif m <= self._today.month:
+                # time-of-day means within the last six months
+                y = self._today.year
+            else:
+                y = self._today.year - 1
+            t = self._localtime.t(y, m, int(day))
+            self._times[key] = t
+        return t
+
+    def _username(self, s):
+        name = self._usernames.get(s)
+        if name is None:
+            name = sys.intern(self._mapper.usernameFromString(s))
+            self._usernames[s] = name
+        return name
+
+    def _groupname(self, s):
+        name = self._groupnames.get(s)
+        if name is None:
+            name = sys.intern(self._mapper.groupnameFromString(s))
+            self._groupnames[s] = name
+        return name
+
+    def parse(self, line):
+        """Return tuple of Filespec fields following the fileset, or None for bad or ignored line."""
+        fields = line.rstrip().split(None, 10)
+        if len(fields) > 10:
+            if self._match is None:
+                path = self._prefix + fields[10]
+            else:
+                path = self._match.sub(self._replace, fields[10])
+            # see if it's a symlink
+            i = path.find(' -> ')
+            if i != -1:
+                target = path[i + 4:]
+                path = path[:i]
+            else:
+                target = None
+            if not self._pathway.ignored(path):
+                return (self._pathway.datasetFromPath(path),
+                        path,
+                        self._username(fields[4]),
+                        self._groupname(fields[5]),
+                        int(fields[6]),
+                        self._t(fields[7], fields[8], fields[9]),
+                        fields[2],
+                        target)
+        return None
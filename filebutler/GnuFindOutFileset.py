@@ -15,30 +15,50 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
-import calendar
-import datetime
-import os
-import re
+import collections
+import concurrent.futures
+import io
 
+from .FilelistSource import FilelistSource
 from .Fileset import Fileset
 from .Filespec import Filespec
-from .Localtime import Localtime
+from .FindLsTokenizer import FindLsTokenizer
 from .PercentageProgress import PercentageProgress
 from .CLIError import CLIError
-from .util import warning, verbose_stderr
+from .util import warning, verbose_stderr, attrint
+
+def _parseLines(parser, lines):
+    """Parse the lines, in a worker process."""
+    records = []
+    for line in lines:
+        record = parser.parse(line)
+        if record is not None:
+            records.append(record)
+    return records
+
+def _parseRange(parser, path, start, end):
+    """Parse the lines in the given byte range of a filelist, in a worker process."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # decode just as for a file opened for reading as text
+    return _parseLines(parser, io.TextIOWrapper(io.BytesIO(data)))
 
 class GnuFindOutFileset(Fileset):
 
+    chunksize = 64 * 1024 * 1024    # bytes of filelist per task in parallel mode
+    progressLines = 4096            # lines between progress reports
+
     @classmethod
-    def parse(cls, ctx, name, toks):
+    def parse(cls, ctx, name, toks, attrs):
         if len(toks) != 3:
             raise CLIError("find.gnu.out requires path, match-re, replace-str")
         path = toks[0]
         match = toks[1]
         replace = toks[2]
-        return cls(ctx, name, path, match, replace)
+        return cls(ctx, name, path, match, replace, attrint(attrs, 'workers', 1))
 
-    def __init__(self, ctx, name, path, match, replace):
+    def __init__(self, ctx, name, path, match, replace, workers=1):
         #print("GnuFindOutFileset init %s %s %s" % (path, match, replace))
         super(self.__class__, self).__init__()
         self._ctx = ctx
@@ -46,72 +66,81 @@ class GnuFindOutFileset(Fileset):
         self._path = path
         self._match = match
         self._replace = replace
-        self._dateParser = self.__class__._dateParser()
+        self._workers = workers
+        self._parser = FindLsTokenizer(ctx, match, replace)
 
     def description(self):
         return "%s filelist %s" % (self.name, self._path)
 
-    class _dateParser(object):
-        """Converts find format dates into time since epoch."""
-        def __init__(self):
-            self._localtime = Localtime()
-            self._monthNumbers = {}  # indexed by month_abbr, of 1 to 12
-            for i in range(12):
-                #print calendar.month_abbr[i + 1], i + 1
-                self._monthNumbers[calendar.month_abbr[i + 1]] = i + 1
-            self._today = datetime.datetime.today()
-            #print "today", self._today.year, self._today.month, self._today.day
+    def _ranges(self, filesize):
+        """Yield byte ranges of the filelist, split at line boundaries."""
+        with open(self._path, 'rb') as f:
+            start = 0
+            while start < filesize:
+                f.seek(start + self.__class__.chunksize)
+                f.readline()
+                end = min(f.tell(), filesize)
+                yield start, end
+                start = end
+
+    def _tasks(self, source):
+        """Yield tasks for worker processes, as (function, args, fraction of filelist read after)."""
+        if source.plain:
+            filesize = source.size()
+            for start, end in self._ranges(filesize):
+                yield _parseRange, (self._parser, self._path, start, end), end * 1.0 / filesize
+        else:
+            # a stream can't be split, so read it here, a chunk of lines at a time
+            with source as f:
+                for lines in iter(lambda: f.readlines(self.__class__.chunksize), []):
+                    yield _parseLines, (self._parser, lines), source.fraction()
 
-        def t(self, fields): # fields are as returned by find -ls, so date is in 7, 8, 9.
-            month = self._monthNumbers[fields[7]]
-            #print "month", month
-            if len(fields[9]) == 4:
-                #print "third field is year"
-                year = int(fields[9])
-            else:
-                #print "third field is time-of-day"
-                if month <= self._today.month:
-                    #print "this year"
-                    year = self._today.year
-                else:
-                    #print "last year"
-                    year = self._today.year - 1
-            #print "year", year
-            return self._localtime.t(year, month, int(fields[8]))
+    def _records(self, source, progress):
+        """Yield parsed records, either directly or from worker processes."""
+        if self._workers <= 1:
+            with source as f:
+                for i, line in enumerate(f):
+                    if progress is not None and i % self.__class__.progressLines == 0:
+                        progress.report(source.fraction())
+                    record = self._parser.parse(line)
+                    if record is not None:
+                        yield record
+        else:
+            verbose_stderr("fileset %s parsing with %d workers\n" % (self.name, self._workers))
+            with concurrent.futures.ProcessPoolExecutor(self._workers) as pool:
+                tasks = self._tasks(source)
+                pending = collections.deque()   # of (future, fraction read)
+                def submit():
+                    task = next(tasks, None)
+                    if task is not None:
+                        fn, args, fraction = task
+                        pending.append((pool.submit(fn, *args), fraction))
+                # keep the workers busy, but limit how many parsed chunks are held in memory
+                for i in range(2 * self._workers):
+                    submit()
+                while pending:
+                    future, fraction = pending.popleft()
+                    records = future.result()
+                    submit()
+                    for record in records:
+                        yield record
+                    if progress is not None:
+                        progress.report(fraction)
 
     def select(self, filter=None):
         verbose_stderr("fileset %s reading from filelist %s\n" % (self.name, self._path))
+        source = FilelistSource(self._path)
         try:
-            filesize = os.stat(self._path).st_size
+            filesize = source.size()
         except OSError as e:
             warning("fileset %s ignoring unreadable filelist %s: %s" % (self.name, self._path, e.strerror))
             return
-        progress = PercentageProgress("reading %s" % self._path)
-        n_read = 0
-        with open(self._path) as f:
-            for line in f:
-                n_read += len(line)
-                progress.report(n_read * 1.0 / filesize)
-                fields = line.rstrip().split(None, 10)
-                if len(fields) > 10:
-                    path = re.sub(self._match, self._replace, fields[10])
-                    # see if it's a symlink
-                    symlink = path.split(' -> ', 1)
-                    if len(symlink) > 1:
-                        path = symlink[0]
-                        target = symlink[1]
-                    else:
-                        target = None
-                    filespec = Filespec(fileset=self,
-                                        dataset=self._ctx.pathway.datasetFromPath(path),
-                                        path=path,
-                                        user=self._ctx.mapper.usernameFromString(fields[4]),
-                                        group=self._ctx.mapper.groupnameFromString(fields[5]),
-                                        size=int(fields[6]),
-                                        mtime=self._dateParser.t(fields),
-                                        perms=fields[2],
-                                        target=target)
-                    if (filter == None or filter.selects(filespec)) and not self._ctx.pathway.ignored(filespec.path):
-                        #print("GnuFindOutFileset read from file %s" % filespec)
-                        yield filespec
-        progress.complete()
+        # progress of a command is unknown
+        progress = PercentageProgress("reading %s" % self._path) if filesize is not None else None
+        for record in self._records(source, progress):
+            filespec = Filespec(self, *record)
+            if filter == None or filter.selects(filespec):
+                #print("GnuFindOutFileset read from file %s" % filespec)
+                yield filespec
+        if progress is not None:
+            progress.complete()
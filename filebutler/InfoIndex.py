@@ -0,0 +1,161 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import mmap
+import os
+import os.path
+import struct
+
+from .CacheCompression import CacheCompression
+from .FilesetInfoAccumulator import FilesetInfoAccumulator
+from .ZoneMap import ZoneMap
+
+class InfoIndex(object):
+    """Index of the info for every fileset in a cache, in a single file.
+
+    The index is written by update-cache from the info files of the new
+    cache.  It holds a fixed size record for each fileset, sorted by its
+    path relative to the cache root, followed by a heap of the variable
+    length data, that is the paths themselves, the zone map paths, and
+    any breakdown by user, dataset, or size as JSON.  The index is mapped
+    into memory and searched by bisection, so reading the info for a
+    fileset doesn't need a system call, nor for a leaf, any JSON.
+
+    Pending deletions are found by a single walk of the deltadir, rather
+    than looking for deleted info alongside each fileset.
+    """
+
+    magic = b'\0FBI'
+    version = 1
+
+    _header = struct.Struct('<4sHHI')   # magic, version, reserved, number of records
+    # path, nFiles, totalSize, has zone, zone minMtime, maxMtime, minSize, maxSize, firstPath, lastPath, breakdown,
+    # with each variable length item as offset into heap and length
+    _record = struct.Struct('<QIqqBddqqQIQIQI')
+
+    @classmethod
+    def write(cls, srcdir, indexpath):
+        """Write the index for the cache tree at srcdir."""
+        records = []
+        for root, dirs, files in os.walk(srcdir):
+            if 'info' in files:
+                with open(os.path.join(root, 'info'), 'rb') as f:
+                    obj = json.load(CacheCompression.reader(f))
+                relpath = os.path.relpath(root, srcdir)
+                key = '' if relpath == '.' else relpath
+                records.append((key.encode('utf-8', 'surrogateescape'), obj))
+        records.sort(key=lambda r: r[0])
+        heap = bytearray()
+        def heapItem(b):
+            offset = len(heap)
+            heap.extend(b)
+            return offset, len(b)
+        with open(indexpath + '.new', 'wb') as f:
+            f.write(cls._header.pack(cls.magic, cls.version, 0, len(records)))
+            for key, obj in records:
+                total = obj['total']
+                zone = obj.get('zone')
+                breakdown = dict([(k, v) for k, v in obj.items() if k not in ('total', 'zone', 'digest')])
+                if zone is not None and zone['firstPath'] is not None:
+                    hasZone = 1
+                    zoneValues = (zone['minMtime'], zone['maxMtime'], zone['minSize'], zone['maxSize'])
+                    first = heapItem(zone['firstPath'].encode('utf-8', 'surrogateescape'))
+                    last = heapItem(zone['lastPath'].encode('utf-8', 'surrogateescape'))
+                else:
+                    hasZone = 0
+                    zoneValues = (0, 0, 0, 0)
+                    first = last = (0, 0)
+                f.write(cls._record.pack(*(heapItem(key) + (total['nFiles'], total['totalSize'], hasZone) + zoneValues + first + last +
+                                           (heapItem(json.dumps(breakdown).encode('utf-8')) if breakdown else (0, 0)))))
+            f.write(heap)
+        os.rename(indexpath + '.new', indexpath)
+
+    def __init__(self, root, deltadir, indexpath):
+        """Open the index, for the cache at root, with its deltadir."""
+        with open(indexpath, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._mmap)
+        magic, version, _, self._n = self._header.unpack_from(self._buf, 0)
+        if magic != self.magic:
+            raise IOError("bad info index %s" % indexpath)
+        if version != self.version:
+            raise IOError("unsupported info index version %d in %s" % (version, indexpath))
+        self._heap = self._header.size + self._n * self._record.size
+        self._root = root
+        self._deltadir = deltadir
+        self._deleted = None    # set of deltadirs with deleted info, when first needed
+
+    def _heapItem(self, offset, length):
+        return bytes(self._buf[self._heap + offset:self._heap + offset + length])
+
+    def _find(self, path):
+        """Return the record for the fileset at path, or None if there isn't one."""
+        if path == self._root:
+            key = b''
+        elif path.startswith(self._root + os.sep):
+            key = path[len(self._root) + 1:].encode('utf-8', 'surrogateescape')
+        else:
+            return None
+        lo = 0
+        hi = self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record.unpack_from(self._buf, self._header.size + mid * self._record.size)
+            k = self._heapItem(record[0], record[1])
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return record
+        return None
+
+    def info(self, path, attrs, sel):
+        """Return the info for the fileset at path, or None if it isn't in the index."""
+        record = self._find(path)
+        if record is None:
+            return None
+        obj = json.loads(self._heapItem(record[13], record[14])) if record[14] > 0 else {}
+        obj['total'] = {'nFiles': record[2], 'totalSize': record[3]}
+        acc = FilesetInfoAccumulator.fromDict(obj, attrs, sel)
+        acc.zone = self._zone(record)
+        return acc
+
+    def zone(self, path):
+        """Return the zone map for the fileset at path, or None if there isn't one."""
+        record = self._find(path)
+        return self._zone(record) if record is not None else None
+
+    def _zone(self, record):
+        if record[4] == 0:
+            return None
+        zone = ZoneMap()
+        zone.minMtime, zone.maxMtime, zone.minSize, zone.maxSize = record[5:9]
+        zone.firstPath = self._heapItem(record[9], record[10]).decode('utf-8', 'surrogateescape')
+        zone.lastPath = self._heapItem(record[11], record[12]).decode('utf-8', 'surrogateescape')
+        return zone
+
+    def hasDeletedInfo(self, deltadir):
+        """Return whether there may be deleted info in deltadir."""
+        if self._deleted is None:
+            self._deleted = set()
+            for root, dirs, files in os.walk(self._deltadir):
+                if 'deleted.info' in files:
+                    self._deleted.add(root)
+        return deltadir in self._deleted
@@ -0,0 +1,123 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+import array
+import fnmatch
+import itertools
+
+from .Filespec import Filespec
+
+class LeafTable(object):
+    """Compact in-memory table of the files in a leaf of the cache.
+
+    A leaf read into memory is kept as a list of filespecs while these
+    fit the read cache budget, and only compacted into a table when they
+    don't.  Size, mtime, and indexes into tables of distinct groups and
+    perms, which are shared by all leaves, are stored as columns, with
+    the paths packed into a single buffer, separated by NULs, which can't
+    occur in a path.  User and dataset are the same for the whole leaf,
+    so aren't stored at all.
+    """
+
+    _groupTable = []
+    _groupIndex = {}
+    _permsTable = []
+    _permsIndex = {}
+
+    # the least of any mtime filter bound
+    _minTime = -(1 << 63)
+
+    def __init__(self, filespecs):
+        self._sizes = array.array('q', [filespec.size for filespec in filespecs])
+        self._mtimes = array.array('q', [filespec.mtime for filespec in filespecs])
+        self._groups = array.array('l', [self._intern(self._groupTable, self._groupIndex, filespec.group) for filespec in filespecs])
+        self._perms = array.array('l', [self._intern(self._permsTable, self._permsIndex, filespec.perms) for filespec in filespecs])
+        paths = [filespec.path.encode('utf-8', 'surrogateescape') for filespec in filespecs]
+        # end of each path, with the next starting after its separator
+        self._ends = array.array('q', itertools.accumulate(len(path) + 1 for path in paths))
+        self._paths = b'\0'.join(paths)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def nbytes(self):
+        """Return the estimated memory used by the table."""
+        return sum([len(column) * column.itemsize for column in (self._sizes, self._mtimes, self._groups, self._perms, self._ends)]) + len(self._paths)
+
+    @classmethod
+    def _intern(cls, table, index, s):
+        i = index.get(s)
+        if i is None:
+            i = index[s] = len(table)
+            table.append(s)
+        return i
+
+    def _path(self, i):
+        return self._paths[self._ends[i - 1] if i > 0 else 0:self._ends[i] - 1].decode('utf-8', 'surrogateescape')
+
+    def _allPaths(self):
+        # decoding the whole buffer at once is much quicker than path by path
+        return self._paths.decode('utf-8', 'surrogateescape').split('\0') if len(self) > 0 else []
+
+    def select(self, filter, fileset, sel):
+        """Yield filespecs for the rows which the filter selects, with owner and dataset taken from the selector."""
+        selected = None         # row numbers, or None for all rows
+        paths = None            # all paths, if decoded
+        if filter is not None:
+            if not filter.consistent:
+                return
+            if filter.owner is not None and filter.owner != sel.owner or filter.dataset is not None and filter.dataset != sel.dataset:
+                return
+            sizeGeq = filter.sizeGeq
+            after = filter.mtime.after if filter.mtime is not None else None
+            before = filter.mtime.before if filter.mtime is not None else None
+            if after is None and before is None:
+                if sizeGeq is not None:
+                    selected = list(itertools.compress(itertools.count(), map(sizeGeq.__le__, self._sizes)))
+            else:
+                # all column predicates in a single pass
+                if after is None:
+                    after = self._minTime
+                if before is None:
+                    before = float('inf')
+                if sizeGeq is None:
+                    selected = [i for i, mtime in enumerate(self._mtimes) if after <= mtime < before]
+                else:
+                    selected = [i for i, (size, mtime) in enumerate(zip(self._sizes, self._mtimes)) if size >= sizeGeq and after <= mtime < before]
+            if len(filter.notPaths) > 0 or filter.regex is not None:
+                paths = self._allPaths()
+                if selected is None:
+                    selected = range(len(paths))
+                for notPath in filter.notPaths:
+                    selected = [i for i in selected if not fnmatch.fnmatchcase(paths[i], notPath)]
+                if filter.regex is not None:
+                    search = filter.regexC.search
+                    selected = [i for i in selected if search(paths[i]) is not None]
+        groups = self._groupTable.__getitem__
+        perms = self._permsTable.__getitem__
+        if selected is None:
+            columns = (self._allPaths(), map(groups, self._groups), self._sizes, self._mtimes, map(perms, self._perms))
+        else:
+            if paths is None and len(selected) * 8 > len(self):
+                paths = self._allPaths()
+            columns = (map(paths.__getitem__ if paths is not None else self._path, selected),
+                       map(groups, map(self._groups.__getitem__, selected)),
+                       map(self._sizes.__getitem__, selected),
+                       map(self._mtimes.__getitem__, selected),
+                       map(perms, map(self._perms.__getitem__, selected)))
+        path, group, size, mtime, perm = columns
+        for filespec in map(Filespec, itertools.repeat(fileset), itertools.repeat(sel.dataset), path, itertools.repeat(sel.owner), group, size, mtime, perm):
+            yield filespec
@@ -37,6 +37,14 @@ class MTimeFilter(object):
         self._before = before
         self._after = after
 
+    @property
+    def before(self):
+        return self._before
+
+    @property
+    def after(self):
+        return self._after
+
     def intersect(self, f1):
         """Return a new filter which is the intersection of self with the parameter f1."""
         if f1 is None:
@@ -0,0 +1,152 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import io
+import mmap
+import os
+import os.path
+import struct
+
+class _Segment(io.RawIOBase):
+    """Raw reader for a segment of a buffer."""
+
+    def __init__(self, buf, offset, length):
+        self._buf = buf
+        self._start = offset
+        self._end = offset + length
+        self._pos = offset
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self._end - self._pos)
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = self._start + offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        else:
+            pos = self._end + offset
+        self._pos = min(max(pos, self._start), self._end)
+        return self._pos - self._start
+
+    def tell(self):
+        return self._pos - self._start
+
+class PackedStore(object):
+    """Store for reading a cache packed into a single file.
+
+    The packfile holds the contents of every file in the cache tree as
+    consecutive segments, followed by an index giving the relative path,
+    offset, and length of each, and finally a trailer giving the offset
+    of the index.  The packfile is mapped into memory, so reading a
+    segment doesn't even need a system call.
+    """
+
+    magic = b'\0FBK'
+    version = 1
+    chunksize = 1024 * 1024     # for copying files into the pack
+
+    _header = struct.Struct('<4sHH')    # magic, version, reserved
+    _entry = struct.Struct('<QQH')      # offset, length, path length
+    _trailer = struct.Struct('<QI4s')   # index offset, number of entries, magic
+
+    @classmethod
+    def pack(cls, srcdir, packpath):
+        """Pack the tree at srcdir into a new packfile."""
+        index = []
+        with open(packpath, 'wb') as pack:
+            pack.write(cls._header.pack(cls.magic, cls.version, 0))
+            offset = cls._header.size
+            for root, dirs, files in os.walk(srcdir):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    length = 0
+                    with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(cls.chunksize), b''):
+                            pack.write(chunk)
+                            length += len(chunk)
+                    index.append((os.path.relpath(path, srcdir), offset, length))
+                    offset += length
+            for relpath, offset0, length in index:
+                b = relpath.encode('utf-8', 'surrogateescape')
+                pack.write(cls._entry.pack(offset0, length, len(b)))
+                pack.write(b)
+            pack.write(cls._trailer.pack(offset, len(index), cls.magic))
+
+    def __init__(self, root, packpath):
+        """Open the packfile, for the tree to be read at root."""
+        with open(packpath, 'rb') as f:
+            self._mtime = os.fstat(f.fileno()).st_mtime
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._mmap)
+        magic, version, _ = self._header.unpack_from(self._buf, 0)
+        if magic != self.magic:
+            raise IOError("bad packfile %s" % packpath)
+        if version != self.version:
+            raise IOError("unsupported packfile version %d in %s" % (version, packpath))
+        indexOffset, nEntries, magic = self._trailer.unpack_from(self._buf, len(self._buf) - self._trailer.size)
+        if magic != self.magic:
+            raise IOError("truncated packfile %s" % packpath)
+        self._files = {}        # of (offset, length), indexed by path
+        self._dirs = {root: []} # of child names, indexed by path
+        pos = indexOffset
+        for i in range(nEntries):
+            offset, length, pathlen = self._entry.unpack_from(self._buf, pos)
+            pos += self._entry.size
+            path = os.path.join(root, bytes(self._buf[pos:pos + pathlen]).decode('utf-8', 'surrogateescape'))
+            pos += pathlen
+            self._files[path] = (offset, length)
+            # add to parent directories, creating as required
+            while True:
+                parent, name = os.path.split(path)
+                children = self._dirs.get(parent)
+                if children is None:
+                    self._dirs[parent] = [name]
+                    path = parent
+                else:
+                    children.append(name)
+                    break
+
+    def listdir(self, path):
+        return list(self._dirs.get(path, []))
+
+    def exists(self, path):
+        return path in self._files or path in self._dirs
+
+    def mtime(self, path):
+        return self._mtime
+
+    def open(self, path, mode='r'):
+        if path not in self._files:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        offset, length = self._files[path]
+        f = io.BufferedReader(_Segment(self._buf, offset, length))
+        if 'b' in mode:
+            return f
+        else:
+            return io.TextIOWrapper(f)
@@ -24,21 +24,32 @@ class Pathway(object):
     def __init__(self):
         self._datasetRegex = None
         self._datasetReplace = None
+        self._datasetGroup = None       # if the replacement is just a group
         self._ignorePathRegexes = []
+        self._ignorePathRegex = None    # all the above combined, if possible
 
     def setDatasetRegex(self, datasetRegex, datasetReplace):
         self._datasetRegex = re.compile(datasetRegex)
         self._datasetReplace = datasetReplace
+        group = re.match(r'\\([1-9][0-9]*)$', datasetReplace)
+        self._datasetGroup = int(group.group(1)) if group is not None and int(group.group(1)) <= self._datasetRegex.groups else None
 
     def clearDatasetRegex(self):
         self._datasetRegex = None
         self._datasetReplace = None
+        self._datasetGroup = None
 
     def datasetFromPath(self, path):
         noDatasetFound = '-'
         if self._datasetRegex is None:
             return noDatasetFound
-        dataset, n = re.subn(self._datasetRegex, self._datasetReplace, path, 1)
+        if self._datasetGroup is not None:
+            # same as the substitution below, without expanding the replacement each time
+            m = self._datasetRegex.search(path)
+            if m is None:
+                return noDatasetFound
+            return path[:m.start()] + (m.group(self._datasetGroup) or '') + path[m.end():]
+        dataset, n = self._datasetRegex.subn(self._datasetReplace, path, 1)
         if n == 1:
             return dataset
         else:
@@ -55,8 +66,28 @@ class Pathway(object):
                     regex = line.strip()
                 if regex != '':
                     self._ignorePathRegexes.append(re.compile(regex))
+        self._ignorePathRegex = self._combined(self._ignorePathRegexes)
+
+    @classmethod
+    def _combined(cls, regexes):
+        """Return a single regex which matches wherever any of regexes does, or None if they can't be combined."""
+        if len(regexes) == 0:
+            return None
+        for r in regexes:
+            # backreferences and conditional group references would be renumbered or rebound
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', r.pattern):
+                return None
+            # global flags would no longer be at the start, which is an error, or before Python 3.11 applies them to all
+            if re.search(r'\(\?[aiLmsux]+\)', r.pattern):
+                return None
+        try:
+            return re.compile('|'.join(['(?:%s)' % r.pattern for r in regexes]))
+        except re.error:
+            return None
 
     def ignored(self, path):
+        if self._ignorePathRegex is not None:
+            return self._ignorePathRegex.search(path) is not None
         for r in self._ignorePathRegexes:
             if re.search(r, path):
                 return True
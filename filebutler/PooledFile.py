@@ -15,11 +15,12 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import errno
 import os
 
 from .FatalError import FatalError
-from .util import debug_log
+from .util import debug_log, Mega
 
 def listdir(path):
     """Just like os.listdir, but close pooled files if hit too many open."""
@@ -27,17 +28,32 @@ def listdir(path):
         files = os.listdir(path)
     except OSError as e:
         if e.errno == errno.EMFILE:
-            debug_log("listdir failed for %s, flush all pooled files\n" % path)
-            PooledFile.flushAll()
+            debug_log("listdir failed for %s, close all pooled files\n" % path)
+            PooledFile.closeDescriptors()
             files = os.listdir(path)
         else:
             raise
     return files
 
 class PooledFile(object):
-    """A File object in a pool, which catches too many open files."""
+    """A File object in a pool, which catches too many open files.
 
-    pool = {}
+    At most maxOpen files in the pool have open descriptors, with the
+    least recently used closed to make room for another.  Writes are
+    buffered in memory, and when the total buffered exceeds writeBuffer,
+    the largest buffers are written out, so each file is written in
+    large batches.
+    """
+
+    pool = {}                           # all files in the pool
+    _opened = collections.OrderedDict() # files with open descriptors, least recently used first
+    _buffered = {}                      # files with pending writes
+    _bufferedSize = 0
+
+    defaultMaxOpen = 256
+    defaultWriteBuffer = 64 * Mega
+    maxOpen = defaultMaxOpen
+    writeBuffer = defaultWriteBuffer
 
     @classmethod
     def flushAll(cls):
@@ -45,11 +61,40 @@ class PooledFile(object):
         for f in list(cls.pool.keys()):
             f.flush()
 
+    @classmethod
+    def closeDescriptors(cls):
+        """Close the descriptors of all files in the pool, leaving their buffers pending."""
+        while len(cls._opened) > 0:
+            cls._closeLeastRecentlyUsed()
+
+    @classmethod
+    def setMaxOpen(cls, n):
+        cls.maxOpen = max(n, 1)
+
+    @classmethod
+    def setWriteBuffer(cls, size):
+        cls.writeBuffer = size
+
+    @classmethod
+    def _closeLeastRecentlyUsed(cls):
+        f, _ = cls._opened.popitem(last=False)
+        f._closeFile()
+
+    @classmethod
+    def _writeLargestBuffers(cls):
+        """Write out the largest buffers, until at most half the memory cap is used."""
+        for f in sorted(cls._buffered.keys(), key=lambda f: f._bufsize, reverse=True):
+            if cls._bufferedSize <= cls.writeBuffer // 2:
+                break
+            f._writeBuffer()
+
     def __init__(self, name, mode='r'):
         self._name = name
         self._mode = mode
         self._file = None
         self._readpos = None
+        self._buf = []
+        self._bufsize = 0
         self.__class__.pool[self] = True
 
     def __enter__(self):
@@ -59,35 +104,67 @@ class PooledFile(object):
         self.close()
 
     def _readmode(self):
-        return self._mode == 'r'
+        return self._mode.startswith('r')
 
     def _open(self):
+        cls = self.__class__
+        while len(cls._opened) >= cls.maxOpen:
+            cls._closeLeastRecentlyUsed()
         try:
             self._file = open(self._name, self._mode)
         except IOError as e:
             if e.errno == errno.EMFILE:
-                debug_log("open failed for %s, flush all pooled files\n" % self._name)
-                # It would be better to implement an LRU cache, but that
-                # hardly seems worth it.  So simply close them all.
-                self.__class__.flushAll()
+                debug_log("open failed for %s, close all pooled files\n" % self._name)
+                # maxOpen is too high for the process, so close them all
+                cls.closeDescriptors()
                 self._file = open(self._name, self._mode)
             else:
                 raise
+        cls._opened[self] = True
         if self._readmode() and self._readpos is not None:
             self._file.seek(self._readpos)
 
+    def _use(self):
+        """Return the open file, marking it as most recently used."""
+        if self._file is None:
+            self._open()
+        else:
+            self.__class__._opened.move_to_end(self)
+        return self._file
+
+    def _closeFile(self):
+        """Close the descriptor, but not the pooled file, which may be reopened."""
+        if self._readmode():
+            self._readpos = self._file.tell()
+        else:
+            # subsequently need to append
+            self._mode = 'a' + self._mode[1:]
+        self._file.close()
+        self._file = None
+
+    def _writeBuffer(self):
+        if self._bufsize > 0:
+            cls = self.__class__
+            buf = (b'' if 'b' in self._mode else '').join(self._buf)
+            self._buf = []
+            cls._bufferedSize -= self._bufsize
+            self._bufsize = 0
+            del cls._buffered[self]
+            self._use().write(buf)
+
     def __iter__(self):
         """Iterate over the lines in a file opened for read."""
         done = False
         while not done:
-            if self._file is None:
-                self._open()
-            line = self._file.readline()
-            if line != '':
+            line = self._use().readline()
+            if line:
                 yield line
             else:
                 done = True
 
+    def read(self, size=-1):
+        return self._use().read(size)
+
     def seek(self, offset):
         if self._file is not None:
             self._file.seek(offset)
@@ -105,22 +182,26 @@ class PooledFile(object):
             raise FatalError("tell on closed PooledFile for write, unsupported")
 
     def write(self, s):
-        if self._file is None:
-            self._open()
-        self._file.write(s)
+        cls = self.__class__
+        # the cap is in bytes, and in text a character may encode as several
+        size = len(s) if isinstance(s, bytes) else len(s.encode('utf-8', 'surrogateescape'))
+        self._buf.append(s)
+        self._bufsize += size
+        cls._bufferedSize += size
+        cls._buffered[self] = True
+        if cls._bufferedSize > cls.writeBuffer:
+            cls._writeLargestBuffers()
 
     def flush(self):
+        self._writeBuffer()
         if self._file is not None:
-            if self._readmode():
-                self._readpos = self._file.tell()
-            else:
-                # subsequently need to append
-                self._mode = 'a'
-            self._file.close()
-            self._file = None
+            del self.__class__._opened[self]
+            self._closeFile()
 
     def close(self):
+        self._writeBuffer()
         if self._file is not None:
+            del self.__class__._opened[self]
             self._file.close()
             self._file = None
         del self.__class__.pool[self]
@@ -0,0 +1,122 @@
+# Copyright 2017-2018 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+
+from .util import debug_log, size2str, Giga
+
+class ReadCache(object):
+    """The in-memory cache of filespecs read from the leaves of all caches, within a memory budget.
+
+    Leaves grow as they are read, and when the total estimated size
+    exceeds the budget, the least recently used are compacted into
+    tables, which are slower to select from but several times smaller,
+    and if that isn't enough, evicted, to be read again from disk when
+    next selected.  A leaf is never compacted or evicted while being
+    selected, but if it can't fit, it stops keeping what it reads.
+    """
+
+    _resident = collections.OrderedDict()   # estimated size of leaves in memory, least recently used first
+    _residentSize = 0
+    _uncompacted = collections.OrderedDict()    # leaves in memory as filespecs, least recently used first
+    hits = 0
+    misses = 0
+    compactions = 0
+    evictions = 0
+
+    # estimated memory for a filespec, in addition to its path
+    filespecOverhead = 320
+    # how much a leaf reads between accounting for it
+    growth = 64 * 1024
+
+    defaultBudget = 1 * Giga
+    budget = defaultBudget
+
+    @classmethod
+    def setBudget(cls, size):
+        cls.budget = size
+        cls._evict()
+
+    @classmethod
+    def hit(cls, leaf):
+        """Count a select of a leaf which is wholly in memory."""
+        cls.hits += 1
+        if leaf in cls._resident:
+            cls._resident.move_to_end(leaf)
+        if leaf in cls._uncompacted:
+            cls._uncompacted.move_to_end(leaf)
+
+    @classmethod
+    def miss(cls, leaf):
+        """Count a select of a leaf which has to be read from disk."""
+        cls.misses += 1
+
+    @classmethod
+    def grow(cls, leaf, size):
+        """Account for more of a leaf read into memory, returning whether it fits the budget."""
+        cls._resident[leaf] = cls._resident.pop(leaf, 0) + size
+        cls._residentSize += size
+        cls._uncompacted[leaf] = cls._uncompacted.pop(leaf, True)
+        cls._evict()
+        return cls._residentSize <= cls.budget
+
+    @classmethod
+    def remove(cls, leaf):
+        """Remove a leaf which no longer keeps what it reads."""
+        cls._residentSize -= cls._resident.pop(leaf, 0)
+        cls._uncompacted.pop(leaf, None)
+
+    @classmethod
+    def release(cls):
+        """Called when a select is done, so its leaves may be evicted."""
+        cls._evict()
+
+    @classmethod
+    def _evict(cls):
+        # compacting is much cheaper than reading from disk again, so is tried first
+        busy = []
+        while cls._residentSize > cls.budget and len(cls._uncompacted) > 0:
+            leaf, _ = cls._uncompacted.popitem(last=False)
+            size = leaf.compact()
+            if size is not None:
+                #debug_log("ReadCache compacted %s\n" % leaf._path)
+                cls._residentSize -= cls._resident[leaf] - size
+                cls._resident[leaf] = size
+                cls.compactions += 1
+            else:
+                # being selected, or only partly read
+                busy.append(leaf)
+        for leaf in busy:
+            cls._uncompacted[leaf] = True
+        busy = []
+        while cls._residentSize > cls.budget and len(cls._resident) > 0:
+            leaf, size = cls._resident.popitem(last=False)
+            if leaf.evict():
+                #debug_log("ReadCache evicted %s\n" % leaf._path)
+                cls._residentSize -= size
+                cls._uncompacted.pop(leaf, None)
+                cls.evictions += 1
+            else:
+                busy.append((leaf, size))
+        # leaves being selected are in use, so most recently used
+        for leaf, size in busy:
+            cls._resident[leaf] = size
+
+    @classmethod
+    def stats(cls):
+        return "read cache %s of %s in %d leaves, %d hits, %d misses, %d compactions, %d evictions" % (
+            size2str(cls._residentSize).strip(), size2str(cls.budget).strip(), len(cls._resident), cls.hits, cls.misses, cls.compactions, cls.evictions)
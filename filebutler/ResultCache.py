@@ -0,0 +1,104 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import os.path
+
+from .FilesetInfo import FilesetInfo
+from .util import warning
+
+class ResultCache(object):
+    """Persistent cache of the info from filtered scans of leaves, shared between sessions.
+
+    Each result is appended as a line of JSON to a single file at the
+    cache root, giving the leaf path relative to the root, the mtime of
+    its filelist when scanned, the filter key, and the info.  A result is
+    only used while the filelist still has that mtime, so rebuilt leaves
+    are rescanned.  Scans include any deleted files, since deletions are
+    subtracted separately, so results aren't invalidated by deletions.
+    """
+
+    def __init__(self, root, path):
+        self._root = root
+        self._path = path
+        self._results = None    # of (mtime, info), indexed by (relpath, filter key), when first needed
+        self._file = None
+        self._writable = True
+
+    @classmethod
+    def _read(cls, path):
+        """Yield the entries in the file at path, ignoring any which are malformed, as from an interrupted write."""
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    relpath, mtime, key, nFiles, totalSize = json.loads(line)
+                except ValueError:
+                    continue
+                yield relpath, mtime, key, nFiles, totalSize
+
+    @classmethod
+    def prune(cls, root, path):
+        """Rewrite the file at path without any results for leaves which have been rebuilt."""
+        if not os.path.exists(path):
+            return
+        mtimes = {}     # of filelist, indexed by relpath
+        with open(path + '.new', 'w') as f:
+            for relpath, mtime, key, nFiles, totalSize in cls._read(path):
+                if relpath not in mtimes:
+                    try:
+                        mtimes[relpath] = os.stat(os.path.join(root, relpath, "filelist")).st_mtime
+                    except OSError:
+                        mtimes[relpath] = None
+                if mtime == mtimes[relpath]:
+                    f.write(json.dumps([relpath, mtime, key, nFiles, totalSize]) + '\n')
+        os.rename(path + '.new', path)
+
+    def _relpath(self, leafpath):
+        # leaves are always beneath the root, so no need for os.path.relpath
+        return leafpath[len(self._root) + 1:]
+
+    def get(self, leafpath, mtime, key):
+        """Return the info for the filter key on the leaf with filelist mtime, or None if not cached."""
+        if self._results is None:
+            self._results = {}
+            try:
+                for relpath, mtime0, key0, nFiles, totalSize in self._read(self._path):
+                    self._results[(relpath, key0)] = (mtime0, FilesetInfo(nFiles, totalSize))
+            except FileNotFoundError:
+                pass
+            except IOError:
+                warning("can't read result cache %s, ignoring" % self._path)
+        result = self._results.get((self._relpath(leafpath), key))
+        if result is not None and result[0] == mtime:
+            return result[1]
+        return None
+
+    def put(self, leafpath, mtime, key, info):
+        """Add the info for the filter key on the leaf with filelist mtime."""
+        relpath = self._relpath(leafpath)
+        self._results[(relpath, key)] = (mtime, info)
+        if not self._writable:
+            return
+        try:
+            if self._file is None:
+                # line buffered, so concurrent sessions append whole lines
+                self._file = open(self._path, 'a', buffering=1)
+            self._file.write(json.dumps([relpath, mtime, key, info.nFiles, info.totalSize]) + '\n')
+        except IOError:
+            # not ours to write, so just keep results for this session
+            self._writable = False
@@ -15,24 +15,94 @@
 # You should have received a copy of the GNU General Public License
 # along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os.path
 
+from .BinaryFilelist import BinaryFilelist
+from .CacheCompression import CacheCompression
+from .ExternalSort import ExternalSort
 from .FilesetCache import FilesetCache
 from .FilesetInfo import FilesetInfo
+from .FilesetInfoAccumulator import FilesetInfoAccumulator
 from .Filespec import Filespec
+from .LeafTable import LeafTable
 from .PooledFile import PooledFile
-from .util import filetimestr, verbose_stderr, debug_log, warning
+from .ReadCache import ReadCache
+from .ZoneMap import ZoneMap
+from .util import filetimestr, verbose_stderr, debug_log, warning, attrsize, Mega
+
+def _stagedpath(filelist, binary):
+    """Return where lines are staged while the filelist is built.
+
+    Binary staging lines aren't a readable filelist, so are kept apart
+    until sorted, lest an update which fails partway leave them in place.
+    """
+    return filelist + ".staged" if binary else filelist
+
+def _sortFilelist(filelist, binary, sortmemory, compression):
+    """Sort the filelist, spilling to temporary files if it's too big to sort in memory."""
+    tmpdir = os.path.dirname(filelist)
+    if binary:
+        sorter = ExternalSort(BinaryFilelist.stagedPath, sortmemory, tmpdir)
+        groups = set()
+        perms = set()
+        def staged(f):
+            for line in f:
+                group, _, _, perms0, _ = line.split(' ', 4)
+                groups.add(group)
+                perms.add(perms0)
+                yield line
+        stagedpath = _stagedpath(filelist, binary)
+        with open(stagedpath) as f:
+            lines = sorter.sort(staged(f))
+        with compression.open(filelist, 'wb') as f:
+            BinaryFilelist.write(f, (BinaryFilelist.unstaged(line) for line in lines), sorted(groups), sorted(perms))
+        os.remove(stagedpath)
+    else:
+        sorter = ExternalSort(Filespec.formattedToPath, sortmemory, tmpdir)
+        with open(filelist) as f:
+            lines = sorter.sort(f)
+        with compression.open(filelist, 'w') as f:
+            f.writelines(lines)
+    if sorter.nRuns > 0:
+        verbose_stderr("sorted %s in %d runs\n" % (filelist, sorter.nRuns))
+
+def _digest(filelist):
+    """Return the digest of the filelist, by which an incremental update sees whether it changed."""
+    h = hashlib.sha1()
+    with open(filelist, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _finalizeLeaf(filelist, binary, sortmemory, compression, incremental, infopath, fileinfo):
+    """Sort the filelist and write the info for a leaf, in a worker process, returning the sizes written compressed."""
+    raw0, stored0 = CacheCompression.written()
+    _sortFilelist(filelist, binary, sortmemory, compression)
+    if incremental and fileinfo is not None:
+        fileinfo.digest = _digest(filelist)
+    with compression.open(infopath, 'w') as infofile:
+        if fileinfo is not None:
+            fileinfo.write(infofile)
+    raw, stored = CacheCompression.written()
+    return raw - raw0, stored - stored0
 
 class SimpleFilesetCache(FilesetCache):
 
-    def __init__(self, parent, path, deltadir, ctx, attrs, sel):
+    def __init__(self, parent, path, deltadir, ctx, attrs, sel, store):
         #debug_log("SimpleFilesetCache(%s)::__init__)\n" % path)
-        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, None)
-        self._filespecs = []    # in-memory read cache
+        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, None, store)
+        self._filespecs = []    # in-memory read cache, within the ReadCache budget
+        self._table = None      # or the same compacted, once complete
+        self._readers = 0       # selects in progress, during which this mustn't be evicted
         self._info = {}         # indexed by filter string
         self._file = None
         self._filepos = 0
         self._deletedFilelist = {}    # paths of deleted files
+        self._binary = 'filelistformat' not in self._attrs or self._attrs['filelistformat'] == ['binary']
+        self._sortmemory = attrsize(self._attrs, 'sortmemory', 256 * Mega)
+        self._zone = None
 
     def filelistpath(self, deleted=False):
         if deleted:
@@ -40,9 +110,52 @@ class SimpleFilesetCache(FilesetCache):
         else:
             return os.path.join(self._path, "filelist")
 
+    def _prune(self, filter):
+        """Return whether filter may select anything here, and the filter reduced by the zone map."""
+        if filter is None or filter.mtime is None and filter.sizeGeq is None and len(filter.notPaths) == 0:
+            # nothing the zone map can help with, so don't read it
+            return True, filter
+        if self._zone is None and self._index is not None:
+            self._zone = self._index.zone(self._path)
+        if self._zone is None:
+            try:
+                with self._store.open(self.infopath(), 'rb') as f:
+                    obj = json.load(CacheCompression.reader(f))
+                if 'zone' in obj:
+                    self._zone = ZoneMap.fromDict(obj['zone'])
+            except IOError:
+                pass
+            if self._zone is None:
+                # cache predates zone maps, so use an empty one, which prunes nothing
+                self._zone = ZoneMap()
+        return self._zone.prune(filter)
+
     def select(self, filter=None, includeDeleted=False):
+        selects, filter = self._prune(filter)
+        if not selects:
+            return
+        self._readers += 1
+        try:
+            for filespec in self._select(filter, includeDeleted):
+                yield filespec
+        finally:
+            self._readers -= 1
+            ReadCache.release()
+
+    def _select(self, filter, includeDeleted):
+        if self._filepos is None:
+            ReadCache.hit(self)
+        else:
+            ReadCache.miss(self)
         # first read from in-memory cache, which may be empty, or partial if last file read was interrupted
         #debug_log("SimpleFilesetCache select %s from memory cache\n" % str(filter))
+        if self._table is not None:
+            # compacted, so complete
+            for filespec in self._table.select(filter, self, self._sel):
+                if includeDeleted or filespec.path not in self._deletedFilelist:
+                    #debug_log("SimpleFilesetCache read from memory %s\n" % filespec)
+                    yield filespec
+            return
         for filespec in self._filespecs:
             if includeDeleted or filespec.path not in self._deletedFilelist:
                 if filter is None or filter.selects(filespec):
@@ -53,13 +166,12 @@ class SimpleFilesetCache(FilesetCache):
         if self._filepos is not None:
             #debug_log("reading filelist from %s cache at %s\n" % (filetimestr(self._path), self._path))
             #debug_log("SimpleFilesetCache(%s) select %s from file cache %s\n" % (self._path, str(filter), self._path))
-            self._deletedFilelist = {}
             filelist = self.filelistpath()
             deletedFilelist = self.filelistpath(deleted=True)
             try:
                 if os.path.exists(deletedFilelist):
                     # if deleted filelist is older than cache, remove it
-                    if os.stat(deletedFilelist).st_mtime < os.stat(filelist).st_mtime:
+                    if os.stat(deletedFilelist).st_mtime < self._store.mtime(filelist):
                         #debug_log("removing obsolete deleted filelist %s\n" % deletedFilelist)
                         os.remove(deletedFilelist)
                     else:
@@ -70,67 +182,182 @@ class SimpleFilesetCache(FilesetCache):
             except IOError:
                 warning("can't read deleted filelist %s, ignoring" % deletedFilelist)
             try:
-                with PooledFile(filelist, 'r') as f:
-                    if self._filepos != 0:
-                        f.seek(self._filepos)
+                with self._store.open(filelist, 'rb') as f0:
+                    f = CacheCompression.reader(f0)
+                    # read either format, so caches may be migrated one at a time
+                    if BinaryFilelist.detect(f):
+                        reader = BinaryFilelist(f, self._filepos)
+                        filespecs = reader.filespecs(self, self._sel)
+                    else:
+                        reader = f
+                        if self._filepos != 0:
+                            f.seek(self._filepos)
+                        filespecs = Filespec.fromFile((line.decode() for line in f), self, self._sel)
                     #debug_log("SimpleFilesetCache(%s) select %s opened file cache as %s at %d\n" % (self._path, filter, f, self._filepos))
+                    keep = True         # whether keeping what's read in memory
+                    size = 0            # read since last accounted for
                     try:
-                        for filespec in Filespec.fromFile(f, self, self._sel):
-                            self._filespecs.append(filespec)
+                        for filespec in filespecs:
+                            if keep:
+                                self._filespecs.append(filespec)
+                                size += ReadCache.filespecOverhead + len(filespec.path)
+                                if size >= ReadCache.growth:
+                                    keep = ReadCache.grow(self, size)
+                                    size = 0
+                                    if not keep:
+                                        # over budget, so read from disk again next time
+                                        ReadCache.remove(self)
+                                        self._filespecs = []
                             if includeDeleted or filespec.path not in self._deletedFilelist:
                                 if filter is None or filter.selects(filespec):
                                     #debug_log("SimpleFilesetCache read from file %s\n" % filespec)
                                     yield filespec
                     except:
                         # on any error save the filepos
-                        self._filepos = f.tell()
+                        if keep:
+                            ReadCache.grow(self, size)
+                            self._filepos = reader.tell()
+                        else:
+                            self._filepos = 0
                         #debug_log("SimpleFilesetCache(%s) exception, saving filepos at %d\n" % (self._path, self._filepos))
                         raise
                     # reading file is complete
-                    self._filepos = None
+                    if keep:
+                        ReadCache.grow(self, size)
+                        self._filepos = None
+                    else:
+                        self._filepos = 0
             except IOError:
                 warning("can't read filelist %s, ignoring" % filelist)
 
+    def compact(self):
+        """Compact the filespecs read into memory into a table, unless being selected or incomplete, returning its size if done."""
+        if self._readers > 0 or self._filepos is not None or self._table is not None:
+            return None
+        self._table = LeafTable(self._filespecs)
+        self._filespecs = []
+        return self._table.nbytes()
+
+    def evict(self):
+        """Drop what was read into memory, unless being selected, returning whether done."""
+        if self._readers > 0:
+            return False
+        self._filespecs = []
+        self._table = None
+        self._filepos = 0
+        return True
+
+    def scan(self, filter=None):
+        # the filelist is read sequentially anyway
+        for filespec in self.select(filter):
+            yield filespec
+
     def merge_info(self, acc, filter=None):
         #debug_log("SimpleFilesetCache(%s) merge_info\n" % self._path)
+        selects, filter = self._prune(filter)
+        if not selects:
+            return
         if not super(self.__class__, self).merge_info(acc, filter):
-            f = str(filter)
+            f = filter.key() if filter is not None else ''
             #debug_log("SimpleFilesetCache(%s)::merge_info(%s)\n" % (self._path, f))
+            if self._hasDeletions():
+                # only those deleted files which the filter selects are to be excluded, so scan without them
+                info = FilesetInfo()
+                for filespec in self.select(filter):
+                    info.add(1, filespec.size)
+                acc.accumulateInfo(info, self._sel)
+                return
             if f in self._info:
                 info = self._info[f]
             else:
-                #debug_log("SimpleFilesetCache(%s)::merge_info(%s) scanning\n" % (self._path, f))
-                info = FilesetInfo()
+                results = self._results
+                mtime = None
+                if results is not None:
+                    try:
+                        mtime = self._store.mtime(self.filelistpath())
+                    except OSError:
+                        # missing, e.g. after update-cache failed partway, so nothing to save results for
+                        results = None
+                info = results.get(self._path, mtime, f) if results is not None else None
+                if info is None:
+                    #debug_log("SimpleFilesetCache(%s)::merge_info(%s) scanning\n" % (self._path, f))
+                    info = FilesetInfo()
+                    for filespec in self.select(filter, includeDeleted=True):
+                        info.add(1, filespec.size)
+                    if results is not None:
+                        results.put(self._path, mtime, f, info)
                 self._info[f] = info
-                for filespec in self.select(filter, includeDeleted=True):
-                    info.add(1, filespec.size)
             acc.accumulateInfo(info, self._sel)
-            acc.decumulateInfo(self._deletedInfo, self._sel)
+
+    def _hasDeletions(self):
+        """Return whether any files here may have been deleted since the cache was updated."""
+        if len(self._deletedFilelist) > 0:
+            return True
+        # the info index knows where deletions are, saving a stat here
+        if self._index is not None:
+            return self._index.hasDeletedInfo(self._deltadir)
+        return os.path.exists(self.filelistpath(deleted=True))
 
     def add(self, filespec):
         super(self.__class__, self).add(filespec)
+        if self._fileinfo.zone is None:
+            self._fileinfo.zone = ZoneMap()
+        self._fileinfo.zone.add(filespec)
         # don't cache writes, as this would mean caching the whole of the filelist
         if self._file is None:
             #debug_log("SimpleFilesetCache writing file cache at %s\n" % self._path)
             if not os.path.exists(self._path):
                 os.makedirs(self._path)
-            self._file = PooledFile(self.filelistpath(), 'w')
-        filespec.write(self._file)
+            self._file = PooledFile(_stagedpath(self.filelistpath(), self._binary), 'w')
+        if self._binary:
+            self._file.write(BinaryFilelist.staged(filespec))
+        else:
+            filespec.write(self._file)
 
-    def finalize(self):
-        """Finalize writing the cache."""
-        #debug_log("SimpleFilesetCache::finalize(%s)\n" % self._path)
+    def addBatch(self, filespecs):
+        """Add filespecs, returning the info for just these."""
+        batchInfo = FilesetInfoAccumulator(self._attrs, self._sel)
+        if self._sel.owner is not None and self._sel.dataset is not None and self._sel.sizebucket is not None:
+            # all here have the same user, dataset, and size bucket, so only the totals differ
+            batchInfo.accumulateInfo(FilesetInfo(len(filespecs), sum([filespec.size for filespec in filespecs])), self._sel)
+        else:
+            for filespec in filespecs:
+                batchInfo.add(filespec)
+        self.addBatchInfo(batchInfo)
+        if self._fileinfo.zone is None:
+            self._fileinfo.zone = ZoneMap()
+        self._fileinfo.zone.addBatch(filespecs)
+        if self._file is None:
+            if not os.path.exists(self._path):
+                os.makedirs(self._path)
+            self._file = PooledFile(_stagedpath(self.filelistpath(), self._binary), 'w')
+        if self._binary:
+            self._file.write(''.join([BinaryFilelist.staged(filespec) for filespec in filespecs]))
+        else:
+            for filespec in filespecs:
+                filespec.write(self._file)
+        return batchInfo
+
+    def _closeFile(self):
         if self._file is not None:
             self._file.close()
             self._file = None
 
-        # sort the filelist
-        with open(self.filelistpath()) as f:
-            sorted_filelist = sorted(f, key=Filespec.formattedToPath)
-        with open(self.filelistpath(), 'w') as f:
-            f.writelines(sorted_filelist)
+    def finalize(self, pool=None):
+        """Finalize writing the cache."""
+        #debug_log("SimpleFilesetCache::finalize(%s)\n" % self._path)
+        self._closeFile()
+        _sortFilelist(self.filelistpath(), self._binary, self._sortmemory, self._compression)
+        if 'incrementalupdate' in self._attrs and self._fileinfo is not None:
+            self._fileinfo.digest = _digest(self.filelistpath())
         super(self.__class__, self).finalize()
 
+    def _submitFinalize(self, pool, futures, parent=None):
+        self._finalizeParent = parent
+        self._closeFile()
+        future = pool.submit(_finalizeLeaf, self.filelistpath(), self._binary, self._sortmemory, self._compression, 'incrementalupdate' in self._attrs, self.infopath(), self._fileinfo)
+        futures[future] = self
+
     def delete(self, filespec):
         #debug_log("SimpleFilesetCache(%s) delete %s\n" % (self._path, filespec.path))
         super(self.__class__, self).delete(filespec)
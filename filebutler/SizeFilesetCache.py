@@ -26,8 +26,8 @@ from .util import str2size, verbose_stderr, debug_log
 
 class SizeFilesetCache(FilesetCache):
 
-    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next):
-        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next)
+    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next, store):
+        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next, store)
         self._sizebuckets = Buckets([str2size(s) for s in self._attrs['sizebuckets']] if 'sizebuckets' in self._attrs else [])
         self._filesets = [None] * self._sizebuckets.len
 
@@ -42,7 +42,7 @@ class SizeFilesetCache(FilesetCache):
 
     def filtered(self, filter=None):
         for i in range(self._sizebuckets.len):
-            if os.path.exists(self._subpath(self._sizebuckets.bound(i))):
+            if self._store.exists(self._subpath(self._sizebuckets.bound(i))):
                 minSize, maxSize = self._sizebuckets.minmax(i)
                 if filter is None or filter.sizeGeq is None or maxSize is None or maxSize >= filter.sizeGeq:
                     if filter is not None and filter.sizeGeq is not None and minSize >= filter.sizeGeq:
@@ -57,5 +57,5 @@ class SizeFilesetCache(FilesetCache):
         self.purge()
         self._filesets = [None] * self._sizebuckets.len
 
-    def filesetFor(self, filespec):
-        return self._fileset(self._sizebuckets.indexContaining(filespec.size))
+    def childKey(self, filespec):
+        return self._sizebuckets.indexContaining(filespec.size)
@@ -0,0 +1,206 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+import fnmatch
+import os
+import os.path
+import re
+import sqlite3
+import urllib.parse
+
+from .Buckets import Buckets
+from .FilesetInfo import FilesetInfo
+from .FilesetSelector import FilesetSelector
+from .Filespec import Filespec
+from .util import str2size, debug_log, warning
+
+def _regexp(pattern, path):
+    return re.search(pattern, path) is not None
+
+def _fnmatch(path, pattern):
+    return fnmatch.fnmatchcase(path, pattern)
+
+class SqliteFilesetCache(object):
+    """Cache of a fileset in a single SQLite database.
+
+    Filters are compiled to SQL, so any combination of them may use the
+    indexes, rather than being limited by the order of the cache levels.
+    Deletions are recorded in the deltadir, as a list of paths, which is
+    loaded into a temporary table to exclude them from queries.
+    """
+
+    batchsize = 10000
+
+    def __init__(self, parent, path, deltadir, ctx, attrs):
+        self._parent = parent
+        self._path = path
+        self._deltadir = deltadir
+        self._ctx = ctx
+        self._attrs = attrs
+        self._sizebuckets = Buckets([str2size(s) for s in self._attrs['sizebuckets']] if 'sizebuckets' in self._attrs else [])
+        self._db = None
+        self._rows = []         # pending insert
+        self._deleted = {}      # paths of deleted files
+
+    def dbpath(self, new=False):
+        return os.path.join(self._path, "cache.db.new" if new else "cache.db")
+
+    def deletedpath(self):
+        return os.path.join(self._deltadir, "deleted.filelist")
+
+    def _connect(self):
+        """Open the database for reading, with deleted paths in a temporary table."""
+        if self._db is None:
+            dbpath = self.dbpath()
+            # check first, as connect would create it
+            if not os.path.exists(dbpath):
+                raise IOError("missing database %s" % dbpath)
+            # quoted, as the path may contain characters special in a URI
+            self._db = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(dbpath)), uri=True)
+            self._db.create_function('regexp', 2, _regexp, deterministic=True)
+            self._db.create_function('fnmatch', 2, _fnmatch, deterministic=True)
+            self._db.execute("CREATE TEMP TABLE deleted (path TEXT PRIMARY KEY)")
+            deletedpath = self.deletedpath()
+            try:
+                if os.path.exists(deletedpath):
+                    # if deleted filelist is older than cache, remove it
+                    if os.stat(deletedpath).st_mtime < os.stat(dbpath).st_mtime:
+                        os.remove(deletedpath)
+                    else:
+                        with open(deletedpath, 'r') as f:
+                            for line in f:
+                                self._deleted[line.rstrip('\n')] = True
+            except IOError:
+                warning("can't read deleted filelist %s, ignoring" % deletedpath)
+            self._db.executemany("INSERT OR IGNORE INTO temp.deleted VALUES (?)", [(path,) for path in self._deleted])
+        return self._db
+
+    def _where(self, filter):
+        """Return the SQL where clause and its parameters for filter."""
+        clauses = ["path NOT IN temp.deleted"]
+        params = []
+        if filter is not None:
+            if not filter.consistent:
+                clauses.append("0")
+            if filter.owner is not None:
+                clauses.append("user = ?")
+                params.append(filter.owner)
+            if filter.dataset is not None:
+                clauses.append("dataset = ?")
+                params.append(filter.dataset)
+            if filter.sizeGeq is not None:
+                clauses.append("size >= ?")
+                params.append(filter.sizeGeq)
+            if filter.mtime is not None:
+                if filter.mtime.after is not None:
+                    clauses.append("mtime >= ?")
+                    params.append(filter.mtime.after)
+                if filter.mtime.before is not None:
+                    clauses.append("mtime < ?")
+                    params.append(filter.mtime.before)
+            for notPath in filter.notPaths:
+                # GLOB is just like fnmatch, except for character classes
+                if '[' in notPath:
+                    clauses.append("NOT fnmatch(path, ?)")
+                else:
+                    clauses.append("path NOT GLOB ?")
+                params.append(notPath)
+            if filter.regex is not None:
+                clauses.append("path REGEXP ?")
+                params.append(filter.regex)
+        return " AND ".join(clauses), params
+
+    def _query(self, filter, order):
+        where, params = self._where(filter)
+        #debug_log("SqliteFilesetCache(%s) WHERE %s %s\n" % (self._path, where, params))
+        cursor = self._connect().execute("SELECT dataset, path, user, grp, size, mtime, perms FROM files WHERE %s%s" % (where, " ORDER BY path" if order else ""), params)
+        for row in cursor:
+            yield Filespec(self, *row)
+
+    def select(self, filter=None):
+        for filespec in self._query(filter, True):
+            yield filespec
+
+    def scan(self, filter=None):
+        for filespec in self._query(filter, False):
+            yield filespec
+
+    def merge_info(self, acc, filter=None):
+        where, params = self._where(filter)
+        cursor = self._connect().execute("SELECT user, dataset, sizebucket, COUNT(*), SUM(size) FROM files WHERE %s GROUP BY user, dataset, sizebucket" % where, params)
+        for user, dataset, sizebucket, nFiles, totalSize in cursor:
+            acc.accumulateInfo(FilesetInfo(nFiles, totalSize), FilesetSelector(user, dataset, self._sizebuckets.bound(sizebucket)))
+        return True
+
+    def create(self):
+        """Create empty database, alongside any previous until finalized."""
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        dbpath = self.dbpath(new=True)
+        if os.path.exists(dbpath):
+            os.remove(dbpath)
+        self._db = sqlite3.connect(dbpath)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE files (dataset TEXT, path TEXT, user TEXT, grp TEXT, size INTEGER, mtime INTEGER, perms TEXT, sizebucket INTEGER)")
+        self._rows = []
+
+    def _flush(self):
+        if self._rows:
+            self._db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._rows)
+            self._rows = []
+
+    def add(self, filespec):
+        self._rows.append((filespec.dataset, filespec.path, filespec.user, filespec.group, filespec.size, filespec.mtime, filespec.perms, self._sizebuckets.indexContaining(filespec.size)))
+        if len(self._rows) >= self.batchsize:
+            self._flush()
+
+    def addBatch(self, filespecs):
+        for filespec in filespecs:
+            self.add(filespec)
+
+    def finalize(self, pool=None):
+        """Index the new database, and replace any previous one."""
+        self._flush()
+        # indexes are much quicker to build all at once
+        for column in ['user', 'dataset', 'mtime', 'size', 'path']:
+            self._db.execute("CREATE INDEX files_%s ON files (%s)" % (column, column))
+        self._db.commit()
+        self._db.execute("ANALYZE")
+        self._db.close()
+        self._db = None
+        os.rename(self.dbpath(new=True), self.dbpath())
+
+    def delete(self, filespec):
+        #debug_log("SqliteFilesetCache(%s) delete %s\n" % (self._path, filespec.path))
+        self._deleted[filespec.path] = True
+        self._connect().execute("INSERT OR IGNORE INTO temp.deleted VALUES (?)", (filespec.path,))
+        self._ctx.pendingCaches.add(self)
+        if self._parent is not None:
+            self._parent.delete(filespec)
+
+    def saveDeletions(self):
+        #debug_log("SqliteFilesetCache(%s)::saveDeletions\n" % self._path)
+        deletedpath = self.deletedpath()
+        try:
+            if not os.path.exists(self._deltadir):
+                os.makedirs(self._deltadir)
+            with open(deletedpath, 'w') as f:
+                for path in self._deleted:
+                    f.write("%s\n" % path)
+        except IOError:
+            warning("can't write deleted filelist %s, ignoring" % deletedpath)
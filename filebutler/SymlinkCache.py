@@ -51,10 +51,11 @@ class SymlinkCache(object):
         target_dir, target_filelist = self._target(os.path.normpath(target))
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
-        f = self._files.get(target)
+        # key by filelist, since distinct targets may normalize to the same one
+        f = self._files.get(target_filelist)
         if f is None:
             f = PooledFile(target_filelist, 'a')
-            self._files[target] = f
+            self._files[target_filelist] = f
         f.write("%s\n" % source)
 
     def purge(self):
@@ -35,6 +35,12 @@ class UnionFileset(Fileset):
         for filespec in merger.merge():
             yield filespec
 
+    def scan(self, filter=None):
+        # no merge, simply each fileset in turn
+        for fileset in self._filesets:
+            for filespec in fileset.scan(filter):
+                yield filespec
+
     def merge_info(self, acc, filter=None):
         for fileset in self._filesets:
             fileset.merge_info(acc, filter)
@@ -24,13 +24,13 @@ from .util import debug_log
 
 class UserFilesetCache(FilesetCache):
 
-    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next):
-        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next)
+    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next, store):
+        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next, store)
         self._users = {}        # of fileset, indexed by username
         self._permissioned = {}        # of boolean, indexed by username
 
         # load stubs for all users found
-        if os.path.exists(self._path):
+        if self._store.exists(self._path):
             for u in self.children():
                 self._users[u] = None # stub
                 self._permissioned[u] = False
@@ -60,18 +60,26 @@ class UserFilesetCache(FilesetCache):
         self._users = {}
         self._permissioned = {}
 
-    def filesetFor(self, filespec):
-        return self._fileset(filespec.user)
+    def childKey(self, filespec):
+        return filespec.user
 
     def add(self, filespec):
         super(self.__class__, self).add(filespec)
-        # special handling for private filesets
-        fileset = self.filesetFor(filespec)
-        if 'private' in self._attrs and os.geteuid() == 0 and not self._permissioned[filespec.user]:
+        self._setPermissions(filespec.user)
+
+    def addBatch(self, filespecs):
+        batchInfo = super(self.__class__, self).addBatch(filespecs)
+        for u in set([filespec.user for filespec in filespecs]):
+            self._setPermissions(u)
+        return batchInfo
+
+    def _setPermissions(self, u):
+        """Special handling for private filesets."""
+        if 'private' in self._attrs and os.geteuid() == 0 and not self._permissioned[u]:
             # set permissions of fileset directory
-            upath = self._subpath(filespec.user)
-            uid = self._ctx.mapper.uidFromUsername(filespec.user)
+            upath = self._subpath(u)
+            uid = self._ctx.mapper.uidFromUsername(u)
             if uid != -1:
                 os.chown(upath, uid, -1)
             os.chmod(upath, 0o500)
-            self._permissioned[filespec.user] = True
+            self._permissioned[u] = True
@@ -26,12 +26,13 @@ from .util import verbose_stderr, debug_log, week_number
 
 class WeeklyFilesetCache(FilesetCache):
 
-    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next):
-        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next)
+    def __init__(self, parent, path, deltadir, ctx, attrs, sel, next, store):
+        super(self.__class__, self).__init__(parent, path, deltadir, ctx, attrs, sel, next, store)
         self._weeks = {}        # of fileset, indexed by integer week
+        self._weekNumbers = {}  # memoized, indexed by quarter hour
 
         # load stubs for all weeks found
-        if os.path.exists(self._path):
+        if self._store.exists(self._path):
             for wstr in self.children():
                 w = int(wstr)
                 self._weeks[w] = None # stub
@@ -72,5 +73,11 @@ class WeeklyFilesetCache(FilesetCache):
         self.purge()
         self._weeks = {}
 
-    def filesetFor(self, filespec):
-        return self._fileset(week_number(filespec.mtime))
+    def childKey(self, filespec):
+        # all timezone offsets are a whole number of quarter hours
+        q = int(filespec.mtime) // 900
+        w = self._weekNumbers.get(q)
+        if w is None:
+            w = week_number(q * 900)
+            self._weekNumbers[q] = w
+        return w
@@ -0,0 +1,115 @@
+# Copyright 2017-2026 Simon Guest
+#
+# This file is part of filebutler.
+#
+# Filebutler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Filebutler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with filebutler.  If not, see <http://www.gnu.org/licenses/>.
+
+from .Filter import Filter
+
+class ZoneMap(object):
+    """Range of mtime, size, and path of the files in a leaf of the cache.
+
+    Used to skip leaves which a filter cannot select, and to drop those
+    parts of a filter which select the whole leaf.
+    """
+
+    @classmethod
+    def fromDict(cls, d):
+        zone = cls()
+        zone.minMtime = d['minMtime']
+        zone.maxMtime = d['maxMtime']
+        zone.minSize = d['minSize']
+        zone.maxSize = d['maxSize']
+        zone.firstPath = d['firstPath']
+        zone.lastPath = d['lastPath']
+        return zone
+
+    def __init__(self):
+        self.minMtime = None
+        self.maxMtime = None
+        self.minSize = None
+        self.maxSize = None
+        self.firstPath = None
+        self.lastPath = None
+
+    def add(self, filespec):
+        if self.firstPath is None:
+            self.minMtime = self.maxMtime = filespec.mtime
+            self.minSize = self.maxSize = filespec.size
+            self.firstPath = self.lastPath = filespec.path
+        else:
+            self.minMtime = min(self.minMtime, filespec.mtime)
+            self.maxMtime = max(self.maxMtime, filespec.mtime)
+            self.minSize = min(self.minSize, filespec.size)
+            self.maxSize = max(self.maxSize, filespec.size)
+            self.firstPath = min(self.firstPath, filespec.path)
+            self.lastPath = max(self.lastPath, filespec.path)
+
+    def addBatch(self, filespecs):
+        mtimes = [filespec.mtime for filespec in filespecs]
+        sizes = [filespec.size for filespec in filespecs]
+        paths = [filespec.path for filespec in filespecs]
+        if self.firstPath is not None:
+            mtimes.append(self.minMtime)
+            mtimes.append(self.maxMtime)
+            sizes.append(self.minSize)
+            sizes.append(self.maxSize)
+            paths.append(self.firstPath)
+            paths.append(self.lastPath)
+        self.minMtime = min(mtimes)
+        self.maxMtime = max(mtimes)
+        self.minSize = min(sizes)
+        self.maxSize = max(sizes)
+        self.firstPath = min(paths)
+        self.lastPath = max(paths)
+
+    def _pathsMatching(self, pattern):
+        """Return whether no, some, or all paths in the zone may match the glob pattern, as 0, 1, 2."""
+        i = 0
+        while i < len(pattern) and pattern[i] not in '*?[':
+            i += 1
+        prefix = pattern[:i]
+        if self.lastPath < prefix or not self.firstPath.startswith(prefix) and self.firstPath > prefix:
+            return 0
+        if pattern[i:] == '*' and self.firstPath.startswith(prefix) and self.lastPath.startswith(prefix):
+            return 2
+        return 1
+
+    def prune(self, filter):
+        """Return whether the filter may select anything in the zone, and the filter reduced to what remains."""
+        if filter is None or self.firstPath is None:
+            return True, filter
+        if filter.mtime is not None:
+            after = filter.mtime.after
+            before = filter.mtime.before
+            if after is not None and self.maxMtime < after or before is not None and self.minMtime >= before:
+                return False, None
+            if (after is None or self.minMtime >= after) and (before is None or self.maxMtime < before):
+                filter = Filter.clearMtime(filter)
+        if filter is not None and filter.sizeGeq is not None:
+            if self.maxSize < filter.sizeGeq:
+                return False, None
+            if self.minSize >= filter.sizeGeq:
+                filter = Filter.clearSize(filter)
+        if filter is not None and len(filter.notPaths) > 0:
+            notPaths = []
+            for notPath in filter.notPaths:
+                matching = self._pathsMatching(notPath)
+                if matching == 2:
+                    return False, None
+                elif matching == 1:
+                    notPaths.append(notPath)
+            if len(notPaths) != len(filter.notPaths):
+                filter = Filter.withNotPaths(filter, notPaths)
+        return True, filter
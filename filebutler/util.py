@@ -210,6 +210,30 @@ def yes_or_no(prompt, default=False):
     except:
         return default
 
+def attrint(attrs, name, default):
+    """Return the value of a single-valued integer attribute, or default if not set."""
+    if name not in attrs:
+        return default
+    values = attrs[name]
+    if len(values) != 1:
+        raise CLIError("botched attr %s" % name)
+    try:
+        return int(values[0])
+    except ValueError:
+        raise CLIError("botched attr %s" % name)
+
+def attrsize(attrs, name, default):
+    """Return the value of a single-valued size attribute, or default if not set."""
+    if name not in attrs:
+        return default
+    values = attrs[name]
+    if len(values) != 1:
+        raise CLIError("botched attr %s" % name)
+    try:
+        return str2size(values[0])
+    except ValueError:
+        raise CLIError("botched attr %s" % name)
+
 def liberal(fn, a, b):
     if a is None:
         return b